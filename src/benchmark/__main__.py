@@ -0,0 +1,303 @@
+import json
+import time
+import timeit
+from threading import Thread, Event
+
+import argparse
+import cv2
+import numpy as np
+
+from src.core.detections import Detections
+from src.core.labels import category_index
+from src.core.redisclient import RedisClient
+from src.core.rules import Rules, classIds
+from src.core.scheduler import Scheduler
+from src.core.videostream import VideoStream, FFmpegVideoStream
+from src.objectdetector.backends import backends, createBackend, warmUp
+
+parser = argparse.ArgumentParser(description="Benchmark parts of the frame -> detection -> light path.")
+subparsers = parser.add_subparsers(dest='benchmark', metavar='benchmark')
+subparsers.required = True
+
+encodingParser = subparsers.add_parser('encoding', help="Compare size and speed of detection encodings.")
+encodingParser.add_argument('-n', '--objects', metavar='N', type=int, nargs='+', default=[0, 5, 20, 100],
+                            help="Number of detected objects per frame. Default 0 5 20 100.")
+encodingParser.add_argument('--repeat', metavar='N', type=int, default=10000,
+                            help="How many times to encode/decode each sample. Default 10000.")
+
+modelParser = argparse.ArgumentParser(add_help=False)
+modelParser.add_argument('-m', '--saved-model', type=str, default="/data/saved_model", help="Pre-trained model to load.")
+modelParser.add_argument('--onnx-model', metavar='model.onnx', type=str, default=None, help="ONNX model for 'onnx' backend.")
+modelParser.add_argument('--trt-cache', metavar='directory', type=str, default="/data/trt_cache",
+                         help="Directory for TensorRT converted models. Default '/data/trt_cache'.")
+modelParser.add_argument('--trt-precision', choices=['FP32', 'FP16', 'INT8'], default='FP16', help="TensorRT precision. Default 'FP16'.")
+modelParser.add_argument('--input-size', metavar='N', type=int, default=320, help="Size of NxN input frames. Default 320.")
+
+backendsParser = subparsers.add_parser('backends', parents=[modelParser],
+                                       help="Compare latency and throughput of inference backends.")
+backendsParser.add_argument('-b', '--backend', choices=backends, nargs='+', default=backends,
+                            help="Backends to compare. Default all.")
+backendsParser.add_argument('--batch', metavar='N', type=int, default=1, help="Frames per inference call. Default 1.")
+backendsParser.add_argument('--warmup', metavar='N', type=int, default=5, help="Calls before measurement starts. Default 5.")
+backendsParser.add_argument('--iterations', metavar='N', type=int, default=50, help="Measured calls. Default 50.")
+
+pipelineParser = subparsers.add_parser('pipeline', parents=[modelParser],
+                                       help="Measure capture, encoding, inference, redis and detection to light latency"
+                                       " on a recorded video.")
+pipelineParser.add_argument('-i', '--video', metavar='video.mp4', type=str, required=True, help="Recorded video to replay.")
+pipelineParser.add_argument('-b', '--backend', choices=backends + ['none'], default='savedmodel',
+                            help="Inference backend, 'none' skips inference. Default 'savedmodel'.")
+pipelineParser.add_argument('--decoder', choices=['opencv', 'ffmpeg'], default='opencv', help="Video decoder. Default 'opencv'.")
+pipelineParser.add_argument('--frames', metavar='N', type=int, default=300, help="Frames to capture. Default 300.")
+pipelineParser.add_argument('--samples', metavar='N', type=int, default=50,
+                            help="Captured frames used to measure encoding, inference and redis. Default 50.")
+pipelineParser.add_argument('-r', '--redis-server', metavar='server:port', type=str, default='localhost:6379',
+                            help="URL to redis server. Default 'localhost:6379'.")
+pipelineParser.add_argument('--fake-redis', action='store_true',
+                            help="Use in-process fakeredis instead of a redis server.")
+pipelineParser.add_argument('-o', '--output', metavar='results.json', type=str, default=None, help="Write results as JSON.")
+pipelineParser.add_argument('--baseline', metavar='results.json', type=str, default=None,
+                            help="Compare with previous results and fail when any of them got worse by more than --tolerance.")
+pipelineParser.add_argument('--tolerance', metavar='N.N', type=float, default=0.2,
+                            help="Allowed relative regression against --baseline. Default 0.2 .")
+
+args = parser.parse_args()
+
+
+def randomDetections(count, random):
+    classes = random.choice(list(category_index.keys()), count)
+    scores = random.uniform(0.3, 1.0, count)
+    boxes = np.sort(random.uniform(0.0, 1.0, (count, 4)), axis=1)
+    return Detections(classes, scores, boxes)
+
+
+def toJsonDict(detections):
+    # detections as they were stored before the binary format
+    return {i: {"class": name, "score": score, "box": box}
+            for i, (name, score, box) in enumerate(zip(detections.names(), detections.scores.tolist(), detections.boxes.tolist()))}
+
+
+def timePerCall(function, repeat):
+    return timeit.timeit(function, number=repeat) / repeat * 1e6
+
+
+def benchmarkEncoding(args):
+    random = np.random.RandomState(0)
+    print("{:>8} {:>10} {:>12} {:>12} {:>10} {:>12} {:>12}".format(
+        "objects", "json B", "json enc us", "json dec us", "binary B", "bin enc us", "bin dec us"))
+
+    for count in args.objects:
+        detections = randomDetections(count, random)
+        jsonDict = toJsonDict(detections)
+        jsonBytes = json.dumps(jsonDict).encode()
+        binaryBytes = detections.encode()
+
+        print("{:>8} {:>10} {:>12.2f} {:>12.2f} {:>10} {:>12.2f} {:>12.2f}".format(
+            count,
+            len(jsonBytes),
+            timePerCall(lambda: json.dumps(jsonDict).encode(), args.repeat),
+            timePerCall(lambda: json.loads(jsonBytes), args.repeat),
+            len(binaryBytes),
+            timePerCall(detections.encode, args.repeat),
+            timePerCall(lambda: Detections.decode(binaryBytes), args.repeat)))
+
+
+def benchmarkBackends(args):
+    random = np.random.RandomState(0)
+    batch = random.randint(0, 256, (args.batch, args.input_size, args.input_size, 3)).astype(np.uint8)
+    print("{:>12} {:>10} {:>10} {:>10} {:>10} {:>12}".format("backend", "startup s", "p50 ms", "p90 ms", "p99 ms", "frames/s"))
+
+    for name in args.backend:
+        start = time.perf_counter()
+        try:
+            model = createBackend(name, args.saved_model, args.onnx_model, args.trt_cache, args.trt_precision,
+                                  args.input_size)
+        except Exception as ex:
+            print("{:>12} not available: {}".format(name, str(ex)))
+            continue
+
+        for _ in range(args.warmup):
+            model(batch)
+        startupTime = time.perf_counter() - start
+
+        latencies = []
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            model(batch)
+            latencies.append(time.perf_counter() - start)
+
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        print("{:>12} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.1f}".format(
+            name, startupTime, p50, p90, p99, args.batch * len(latencies) / sum(latencies)))
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99]) * 1000
+    return {'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'mean_ms': float(np.mean(samples)) * 1000, 'count': len(samples)}
+
+
+def measure(function, *items):
+    durations = []
+    results = []
+    for item in items:
+        start = time.perf_counter()
+        results.append(function(item))
+        durations.append(time.perf_counter() - start)
+    return results, durations
+
+
+def measureCapture(args):
+    if args.decoder == 'ffmpeg':
+        stream = FFmpegVideoStream(args.video, (args.input_size, args.input_size))
+    else:
+        stream = VideoStream(args.video)
+
+    try:
+        first = stream.read_new(10)
+        if first is None:
+            raise RuntimeError("Can not read video '{}'.".format(args.video))
+
+        # capture thread runs on its own, its speed is given by sequence numbers of frames it published
+        samples = [first.image.copy()]
+        last = first
+        while last.sequence - first.sequence < args.frames:
+            frame = stream.read_new(5)
+            if frame is None:
+                break
+            last = frame
+            if len(samples) < args.samples:
+                samples.append(frame.image.copy())
+    finally:
+        stream.release()
+
+    elapsed = last.timestamp - first.timestamp
+    fps = (last.sequence - first.sequence) / elapsed if elapsed > 0 else 0.0
+    return {'fps': fps, 'frames': last.sequence - first.sequence}, samples
+
+
+def connectBenchmarkRedis(args):
+    if args.fake_redis:
+        import fakeredis
+        return RedisClient(args.redis_server, 'benchmark', redis=fakeredis.FakeRedis())
+    return RedisClient(args.redis_server, 'benchmark')
+
+
+class BenchmarkLight:
+    def __init__(self):
+        self.switchedOn = None
+
+    def switch(self, on):
+        if on:
+            self.switchedOn = time.time()
+
+
+def measureEndToEnd(redis, frameBytes, count, interval=0.05):
+    # lightcontrol path: wait for detection id, read detections, evaluate rules, switch light
+    detections = Detections([classIds['person']], [0.9], [[0.2, 0.2, 0.8, 0.6]])
+    rules = Rules([{'name': 'benchmark', 'classes': ['person'], 'pin': -1, 'period': interval / 5}])
+    light = BenchmarkLight()
+    scheduler = Scheduler()
+    published = {}
+    latencies = []
+    stopped = Event()
+
+    def consume():
+        while not stopped.is_set():
+            detectionId = redis.waitForDetectionId(0.5)
+            if detectionId is None or detectionId not in published:
+                continue
+            for _ in rules.evaluate(redis.getDetectionsOnly(detectionId)).nonzero()[0]:
+                scheduler.trigger(light, rules.periods[0])
+                # a light which was still on is only extended, it has no new switching time
+                if light.switchedOn is not None:
+                    latencies.append(light.switchedOn - published[detectionId])
+                    light.switchedOn = None
+
+    # skip ids written by previous measurements, before the consumer thread uses the stream cursor
+    redis.waitForDetectionId(0)
+    consumer = Thread(target=consume)
+    consumer.start()
+    try:
+        time.sleep(interval)
+        for frameId in range(count):
+            published[frameId + 1000000] = time.time()
+            redis.addFrameWithDetections(frameId + 1000000, frameBytes, detections)
+            time.sleep(interval)
+    finally:
+        stopped.set()
+        consumer.join()
+        scheduler.stop()
+    return latencies
+
+
+def benchmarkPipeline(args):
+    results = {}
+    results['capture'], frames = measureCapture(args)
+
+    encoded, durations = measure(lambda frame: cv2.imencode('.jpg', frame)[1].tobytes(), *frames)
+    results['encode'] = percentiles(durations)
+
+    detections = [Detections.empty()] * len(frames)
+    results['inference'] = None
+    if args.backend != 'none':
+        model = createBackend(args.backend, args.saved_model, args.onnx_model, args.trt_cache, args.trt_precision,
+                              args.input_size)
+        warmUp(model, 1, args.input_size)
+        outputs, durations = measure(lambda frame: model(frame[np.newaxis, ...]), *frames)
+        results['inference'] = percentiles(durations)
+        detections = [Detections(output['detection_classes'], output['detection_scores'], output['detection_boxes'])
+                      for output in outputs]
+
+    redis = connectBenchmarkRedis(args)
+    ids = range(len(frames))
+    _, durations = measure(lambda i: redis.addFrameWithDetections(i, encoded[i], detections[i]), *ids)
+    results['redis_write'] = percentiles(durations)
+    _, durations = measure(redis.getDetectionsOnly, *ids)
+    results['redis_read_detections'] = percentiles(durations)
+    _, durations = measure(lambda i: redis.getFrameData(i).frame, *ids)
+    results['redis_read_frame'] = percentiles(durations)
+
+    results['end_to_end'] = percentiles(measureEndToEnd(redis, encoded[0], len(frames)))
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        checkRegressions(args, results)
+
+
+def checkRegressions(args, results):
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not result or not previous:
+            continue
+        if 'fps' in result and result['fps'] < previous['fps'] * (1 - args.tolerance):
+            regressions.append("{}: {:.1f} fps, was {:.1f} fps".format(name, result['fps'], previous['fps']))
+        if 'p50_ms' in result and result['p50_ms'] > previous['p50_ms'] * (1 + args.tolerance):
+            regressions.append("{}: p50 {:.2f} ms, was {:.2f} ms".format(name, result['p50_ms'], previous['p50_ms']))
+
+    if regressions:
+        parser.exit(1, "Regressions against '{}':\n{}\n".format(args.baseline, "\n".join(regressions)))
+    print("No regressions against '{}'.".format(args.baseline))
+
+
+benchmarks = {
+    'encoding': benchmarkEncoding,
+    'backends': benchmarkBackends,
+    'pipeline': benchmarkPipeline
+}
+
+
+def main():
+    benchmarks[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import numpy as np
+
+from src.core.labels import category_names
+
+
+class Detections:
+    # Columnar wire format: count header followed by scores, boxes, track ids, class ids and hits.
+    # Columns are ordered by item size, so every column stays aligned in the buffer.
+    # Track id 0 means the object is not tracked, hits is number of frames the model detected the object in,
+    # 0 for tracked objects which the model missed in its last run.
+    countType = np.dtype('<u4')
+    scoreType = np.dtype('<f4')
+    boxType = np.dtype('<f4')
+    trackType = np.dtype('<u4')
+    classType = np.dtype('<u2')
+    hitsType = np.dtype('<u2')
+
+    def __init__(self, classes, scores, boxes, trackIds=None, hits=None):
+        self.classes = np.asarray(classes, dtype=self.classType)
+        self.scores = np.asarray(scores, dtype=self.scoreType)
+        self.boxes = np.asarray(boxes, dtype=self.boxType).reshape(-1, 4)
+        self.trackIds = np.zeros(len(self.scores), dtype=self.trackType) if trackIds is None \
+            else np.asarray(trackIds, dtype=self.trackType)
+        self.hits = np.ones(len(self.scores), dtype=self.hitsType) if hits is None \
+            else np.asarray(hits, dtype=self.hitsType)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def names(self):
+        return category_names[self.classes].tolist()
+
+    def encode(self):
+        count = np.array([len(self)], dtype=self.countType)
+        return b''.join([count.tobytes(), self.scores.tobytes(), self.boxes.tobytes(), self.trackIds.tobytes(),
+                         self.classes.tobytes(), self.hits.tobytes()])
+
+    @classmethod
+    def decode(cls, data):
+        # arrays are views into data, nothing is copied
+        count = int(np.frombuffer(data, dtype=cls.countType, count=1)[0])
+        offset = cls.countType.itemsize
+        scores = np.frombuffer(data, dtype=cls.scoreType, count=count, offset=offset)
+        offset += scores.nbytes
+        boxes = np.frombuffer(data, dtype=cls.boxType, count=count * 4, offset=offset)
+        offset += boxes.nbytes
+        if len(data) == offset + count * cls.classType.itemsize:
+            # written before tracking, without track ids and hits
+            return cls(np.frombuffer(data, dtype=cls.classType, count=count, offset=offset), scores, boxes)
+
+        trackIds = np.frombuffer(data, dtype=cls.trackType, count=count, offset=offset)
+        offset += trackIds.nbytes
+        classes = np.frombuffer(data, dtype=cls.classType, count=count, offset=offset)
+        offset += classes.nbytes
+        hits = np.frombuffer(data, dtype=cls.hitsType, count=count, offset=offset)
+        return cls(classes, scores, boxes, trackIds, hits)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [])
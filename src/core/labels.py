@@ -1,3 +1,5 @@
+import numpy as np
+
 # https://gist.github.com/xhlulu/f7735970704b97fd0b72203628c1cc77
 
 category_map = {
@@ -164,4 +166,7 @@ category_index = {
     88: {'id': 88, 'name': 'teddy bear'},
     89: {'id': 89, 'name': 'hair drier'},
     90: {'id': 90, 'name': 'toothbrush'}
-}
\ No newline at end of file
+}
+
+# category_names[classId] is name of the class, '' for ids not used by COCO
+category_names = np.array([category_map.get(classId, '') for classId in range(max(category_map) + 1)])
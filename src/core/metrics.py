@@ -0,0 +1,142 @@
+import time
+from threading import Lock, Thread
+from contextlib import contextmanager
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Minimal Prometheus compatible metrics, exposed in text format on http://host:port/metrics
+
+latencyBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labels)
+        self.values = {}  # label values -> value
+        self.lock = Lock()
+
+    def formatLabels(self, labelValues, extra=()):
+        pairs = list(zip(self.labelNames, labelValues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for name, value in pairs) + '}'
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        with self.lock:
+            for labelValues, value in sorted(self.values.items()):
+                lines.extend(self.exposeValue(labelValues, value))
+        return lines
+
+    def exposeValue(self, labelValues, value):
+        return ['{}{} {}'.format(self.name, self.formatLabels(labelValues), value)]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelValues, amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labelValues):
+        with self.lock:
+            self.values[labelValues] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=latencyBuckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelValues):
+        with self.lock:
+            counts = self.values.get(labelValues)
+            if counts is None:
+                # per bucket counts, then sum and count of all observations
+                counts = self.values[labelValues] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, *labelValues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelValues)
+
+    def exposeValue(self, labelValues, counts):
+        lines = ['{}_bucket{} {}'.format(self.name, self.formatLabels(labelValues, [('le', bound)]), count)
+                 for bound, count in zip(self.buckets, counts)]
+        lines.append('{}_bucket{} {}'.format(self.name, self.formatLabels(labelValues, [('le', '+Inf')]), counts[-1]))
+        lines.append('{}_sum{} {}'.format(self.name, self.formatLabels(labelValues), counts[-2]))
+        lines.append('{}_count{} {}'.format(self.name, self.formatLabels(labelValues), counts[-1]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def register(self, metric):
+        with self.lock:
+            # modules may be imported more than once (e.g. as __main__), keep the first instance
+            return self.metrics.setdefault(metric.name, metric)
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.expose()) + '\n'
+
+
+registry = Registry()
+
+counter = lambda name, help, labels=(): registry.register(Counter(name, help, labels))
+gauge = lambda name, help, labels=(): registry.register(Gauge(name, help, labels))
+histogram = lambda name, help, labels=(), buckets=latencyBuckets: registry.register(Histogram(name, help, labels, buckets))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = registry.expose().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host=''):
+    server = MetricsServer((host, port), MetricsHandler)
+    thread = Thread(target=server.serve_forever, args=())
+    thread.daemon = True
+    thread.start()
+    print("Metrics are served on port {}.".format(port), flush=True)
+    return server
@@ -0,0 +1,60 @@
+import time
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    width = 160
+    pixelThreshold = 25  # gray level difference considered as a change
+    learningRate = 0.05
+
+    def __init__(self, threshold, refreshPeriod=0):
+        # threshold: minimal fraction of changed pixels, 0 disables the gate
+        # refreshPeriod: let a frame through at least each N seconds even if nothing moved, 0 never
+        self.threshold = threshold
+        self.refreshPeriod = refreshPeriod
+        self.background = None
+        self.lastPassed = 0
+        self.moved = False  # last frame changed more than threshold, refreshed frames do not count
+        self.checked = 0
+        self.skipped = 0
+
+    def hasChanged(self, frame):
+        self.checked += 1
+        if self.threshold <= 0:
+            return self.passed()
+
+        gray = self.toGray(frame)
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray.astype(np.float32)
+            return self.passed()
+
+        difference = cv2.absdiff(gray, cv2.convertScaleAbs(self.background))
+        changed = np.count_nonzero(difference > self.pixelThreshold) / difference.size
+        cv2.accumulateWeighted(gray, self.background, self.learningRate)
+
+        self.moved = changed >= self.threshold
+        if self.moved or self.shouldRefresh():
+            return self.passed()
+
+        self.skipped += 1
+        return False
+
+    def skipRatio(self):
+        return self.skipped / self.checked if self.checked else 0.0
+
+    def passed(self):
+        self.lastPassed = time.time()
+        return True
+
+    def shouldRefresh(self):
+        return self.refreshPeriod > 0 and time.time() - self.lastPassed >= self.refreshPeriod
+
+    def toGray(self, frame):
+        height, width = frame.shape[:2]
+        size = (self.width, max(1, int(height * self.width / width)))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
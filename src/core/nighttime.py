@@ -1,30 +1,58 @@
-from datetime import datetime;
+from datetime import datetime, timedelta, time
 
 from suntime import Sun, SunTimeException
 
 class NightTime:
     halfDayInSeconds = 12*60*60
-    
+
     # Slovakia
     latitude = 48.414980208990976
     longitude = 18.223144711888395
 
-    now = lambda self: datetime.now().timestamp() 
+    now = lambda self: datetime.now().timestamp()
+
+    def __init__(self, latitude=None, longitude=None):
+        if latitude is not None:
+            self.latitude = latitude
+        if longitude is not None:
+            self.longitude = longitude
 
-    def __init__(self):
         self.sun = Sun(self.latitude, self.longitude)
-        self.sunset = 0
-        self.sunrise = 0
+        self.schedule = {}  # date -> (sunrise, sunset) timestamps
+        self.night = False
+        self.nextTransition = 0
 
     def isNight(self):
+        # state changes only at sunset and midnight, until then the cached answer is valid
         currentTime = self.now()
-        return currentTime > self.getSunset() # or self.getSunrise() > currentTime   # disabled to work only till midnight
+        if currentTime >= self.nextTransition:
+            self.update(currentTime)
+        return self.night
+
+    def update(self, currentTime):
+        today = datetime.fromtimestamp(currentTime).date()
+        sunset = self.getSunset(today)
+        midnight = datetime.combine(today + timedelta(days=1), time()).timestamp()
+
+        self.night = currentTime > sunset # or self.getSunrise(today) > currentTime   # disabled to work only till midnight
+        self.nextTransition = midnight if self.night else sunset
 
     def secondsTillNight(self):
         return self.getSunset() - self.now()
 
-    def getSunrise(self):
-        return self.sun.get_sunrise_time().timestamp()
+    def secondsTillTransition(self):
+        self.isNight()
+        return max(self.nextTransition - self.now(), 0)
+
+    def getSunrise(self, date=None):
+        return self.getSchedule(date)[0]
+
+    def getSunset(self, date=None):
+        return self.getSchedule(date)[1]
 
-    def getSunset(self):
-        return self.sun.get_sunset_time().timestamp()
+    def getSchedule(self, date=None):
+        date = date or datetime.now().date()
+        if date not in self.schedule:
+            self.schedule[date] = (self.sun.get_sunrise_time(date).timestamp(),
+                                   self.sun.get_sunset_time(date).timestamp())
+        return self.schedule[date]
@@ -0,0 +1,137 @@
+import time
+from queue import Queue, Empty
+from threading import Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from src.core import metrics
+
+itemsDropped = metrics.counter('pipeline_items_dropped_total', "Items dropped because next stage was busy.", ['stage'])
+stageSeconds = metrics.histogram('pipeline_stage_seconds', "Time spent processing one item by pipeline stage.", ['stage'])
+stageErrors = metrics.counter('pipeline_stage_errors_total', "Errors raised by pipeline stage.", ['stage'])
+queueDepth = metrics.gauge('pipeline_queue_depth', "Items waiting for pipeline stage.", ['stage'])
+
+
+class DropOldestQueue(Queue):
+    # Bounded queue which never blocks producer. When full, the oldest item is discarded
+    # so consumer always works on the most recent data and latency stays bounded.
+    def __init__(self, maxsize, name=''):
+        super().__init__(maxsize)
+        self.name = name
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                self._get()
+                self.unfinished_tasks -= 1
+                self.dropped += 1
+                itemsDropped.inc(self.name)
+            self._put(item)
+            self.unfinished_tasks += 1
+            queueDepth.set(self._qsize(), self.name)
+            self.not_empty.notify()
+
+
+class Stage:
+    pollTimeout = 0.5
+
+    def __init__(self, name, function, inputQueue=None, outputQueue=None):
+        self.name = name
+        self.function = function
+        self.inputQueue = inputQueue
+        self.outputQueue = outputQueue
+        self.lock = Lock()
+        self.processed = 0
+        self.busyTime = 0.0
+        self.errors = 0
+
+    def run(self, stopEvent):
+        while not stopEvent.is_set():
+            if self.inputQueue is None:
+                self.process(stopEvent, ())
+                continue
+
+            try:
+                item = self.inputQueue.get(timeout=self.pollTimeout)
+            except Empty:
+                continue
+            queueDepth.set(self.inputQueue.qsize(), self.name)
+            self.process(stopEvent, (item,))
+
+    def process(self, stopEvent, item):
+        start = time.perf_counter()
+        try:
+            result = self.function(*item)
+        except Exception as ex:
+            self.errors += 1
+            stageErrors.inc(self.name)
+            print("Error in pipeline stage '{}': {}".format(self.name, str(ex)), flush=True)
+            # source stages would otherwise spin on permanent errors
+            stopEvent.wait(self.pollTimeout)
+            return
+
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.busyTime += duration
+            # source stage returning None means nothing was captured
+            if result is not None or self.inputQueue is not None:
+                self.processed += 1
+                stageSeconds.observe(duration, self.name)
+
+        if result is not None and self.outputQueue is not None:
+            self.outputQueue.put(result)
+
+    def snapshot(self):
+        with self.lock:
+            return self.processed, self.busyTime
+
+
+class Pipeline:
+    def __init__(self, queueSize=2):
+        self.queueSize = queueSize
+        self.stages = []
+        self.stopEvent = Event()
+        self.executor = None
+        self.futures = []
+        self.lastReport = None
+
+    def addStage(self, name, function):
+        inputQueue = None
+        if self.stages:
+            inputQueue = DropOldestQueue(self.queueSize, name)
+            self.stages[-1].outputQueue = inputQueue
+        self.stages.append(Stage(name, function, inputQueue))
+        return self
+
+    def start(self):
+        self.stopEvent.clear()
+        self.executor = ThreadPoolExecutor(max_workers=len(self.stages), thread_name_prefix='pipeline')
+        self.futures = [self.executor.submit(stage.run, self.stopEvent) for stage in self.stages]
+        self.lastReport = (time.perf_counter(), [stage.snapshot() for stage in self.stages])
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def isRunning(self):
+        return self.executor is not None and not any(future.done() for future in self.futures)
+
+    def report(self):
+        now = time.perf_counter()
+        snapshots = [stage.snapshot() for stage in self.stages]
+        lastTime, lastSnapshots = self.lastReport
+        elapsed = max(now - lastTime, 1e-9)
+        self.lastReport = (now, snapshots)
+
+        lines = []
+        for stage, (processed, busyTime), (lastProcessed, lastBusyTime) in zip(self.stages, snapshots, lastSnapshots):
+            count = processed - lastProcessed
+            latency = (busyTime - lastBusyTime) / count * 1000 if count else 0.0
+            queue = stage.inputQueue
+            lines.append("{}: {:.2f} items/s, {:.1f} ms/item, queue {}/{}, dropped {}, errors {}".format(
+                stage.name, count / elapsed, latency,
+                queue.qsize() if queue else 0, queue.maxsize if queue else 0,
+                queue.dropped if queue else 0, stage.errors))
+        return lines
@@ -1,50 +1,164 @@
+import time
+from threading import Lock
+
 import numpy as np
-import json
 
-from redis import Redis
+from redis import Redis, ConnectionPool, UnixDomainSocketConnection
+from redis.exceptions import ConnectionError, TimeoutError
+
+from src.core import metrics
+from src.core.detections import Detections
+
+operationSeconds = metrics.histogram('redis_operation_seconds', "Duration of redis round trips.", ['operation'])
+operationRetries = metrics.counter('redis_operation_retries_total', "Redis operations retried after connection error.", ['operation'])
+
+# clients of all sessions connected to the same server share one pool of connections
+connectionPools = {}
+poolsLock = Lock()
+
+
+def getConnectionPool(serverUrl, socketTimeout=5.0, healthCheckInterval=30):
+    # serverUrl is 'host', 'host:port' or path to unix socket as 'unix:///path/redis.sock' or '/path/redis.sock'
+    key = (serverUrl, socketTimeout, healthCheckInterval)
+    with poolsLock:
+        pool = connectionPools.get(key)
+        if pool is not None:
+            return pool
+
+        # idle connections are pinged before use, so a dropped connection is replaced instead of failing a call
+        options = {'socket_timeout': socketTimeout, 'health_check_interval': healthCheckInterval}
+        if serverUrl.startswith('unix://') or serverUrl.startswith('/'):
+            pool = ConnectionPool(connection_class=UnixDomainSocketConnection,
+                                  path=serverUrl[len('unix://'):] if serverUrl.startswith('unix://') else serverUrl,
+                                  **options)
+        else:
+            server, _, port = serverUrl.partition(':')
+            pool = ConnectionPool(host=server, port=int(port or 6379), socket_connect_timeout=socketTimeout,
+                                  socket_keepalive=True, **options)
+        connectionPools[key] = pool
+        return pool
+
+
+class FrameData:
+    # raw redis values are decoded only when accessed
+    def __init__(self, frameId, imageBytes, detectionBytes):
+        self.frameId = frameId
+        self.imageBytes = imageBytes
+        self.detectionBytes = detectionBytes
+        self._frame = None
+        self._detections = None
+
+    @property
+    def frame(self):
+        if self._frame is None and self.imageBytes is not None:
+            self._frame = np.frombuffer(self.imageBytes, dtype=np.int8)
+        return self._frame
+
+    @property
+    def detections(self):
+        if self._detections is None and self.detectionBytes is not None:
+            self._detections = Detections.decode(self.detectionBytes)
+        return self._detections
+
 
 class RedisClient:
     formatKey = lambda self, frameKey: '{}:{}'.format(self.session, frameKey)
     FRAME = "image"
     DETECTIONS = "detections"
+    streamLength = 100
+    retryDelay = 0.1  # seconds, doubled after every failed attempt
+    maxRetryDelay = 2.0
 
-    def __init__(self, serverUrl, session='default', ttl=600):
-        if ':' in serverUrl:
-            server, port = serverUrl.split(':')
-            self.redis = Redis(host=server, port=port)
+    def __init__(self, serverUrl, session='default', ttl=600, redis=None, socketTimeout=5.0, retries=3):
+        # redis: already created connection to use instead of connecting to serverUrl
+        if redis is not None:
+            self.redis = redis
         else:
-            self.redis = Redis(host=serverUrl)
-        
+            self.redis = Redis(connection_pool=getConnectionPool(serverUrl, socketTimeout))
+
+        self.socketTimeout = socketTimeout
+        self.retries = retries
         self.ttl = ttl
         self.session = session
         self.lastFrameKey = '{}:lastframeid'.format(session)
         self.lastDetectionKey = '{}:lastdetectionid'.format(session)
-         
+        # every new id is also appended to a stream, so consumers can block on it instead of polling
+        self.streamKeys = {
+            self.lastFrameKey: '{}:framestream'.format(session),
+            self.lastDetectionKey: '{}:detectionstream'.format(session)
+        }
+        self.streamCursors = {}
+
+    def call(self, operation, function, *args, **kwargs):
+        # connection errors are retried with exponential backoff, the pool reconnects on next attempt
+        delay = self.retryDelay
+        for attempt in range(self.retries + 1):
+            try:
+                with operationSeconds.time(operation):
+                    return function(*args, **kwargs)
+            except (ConnectionError, TimeoutError) as ex:
+                if attempt == self.retries:
+                    raise
+                operationRetries.inc(operation)
+                print("Redis {} failed ({}), retrying in {:.1f} s.".format(operation, str(ex), delay), flush=True)
+                time.sleep(delay)
+                delay = min(delay * 2, self.maxRetryDelay)
+
+    def ping(self):
+        return self.call('ping', self.redis.ping)
+
     def addFrame(self, frameId, frame):
         self.addData(frameId, frame, self.FRAME, self.lastFrameKey)
         
     def addDetections(self, frameId, detections):
-        jsonDetections = json.dumps(detections)
-        self.addData(frameId, jsonDetections, self.DETECTIONS, self.lastDetectionKey)
+        self.addData(frameId, detections.encode(), self.DETECTIONS, self.lastDetectionKey)
+
+    def addFrameWithDetections(self, frameId, frame, detections):
+        self.addValues(frameId, {self.FRAME: frame, self.DETECTIONS: detections.encode()},
+                       [self.lastFrameKey, self.lastDetectionKey])
 
     def addData(self, frameId, data, hKeyName, lastKeyName):
+        self.addValues(frameId, {hKeyName: data}, [lastKeyName])
+
+    def addValues(self, frameId, values, lastKeyNames):
+        self.call('write', self.writeValues, frameId, values, lastKeyNames)
+
+    def writeValues(self, frameId, values, lastKeyNames):
+        # single MULTI/EXEC round trip, readers never see last id before the hash it points to,
+        # failed transaction is not applied, so the whole write can be retried
         key = self.formatKey(frameId)
-        self.redis.hset(key, hKeyName, data)
-        self.redis.expire(key, self.ttl)
-        self.redis.setex(lastKeyName, self.ttl, frameId)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(key, mapping=values)
+        pipe.expire(key, self.ttl)
+        for lastKeyName in lastKeyNames:
+            streamKey = self.streamKeys[lastKeyName]
+            pipe.setex(lastKeyName, self.ttl, frameId)
+            pipe.xadd(streamKey, {'id': frameId}, maxlen=self.streamLength, approximate=True)
+            pipe.expire(streamKey, self.ttl)
+        pipe.execute()
 
     def getFrame(self, frameId):
         imageBytes = self.getData(frameId, self.FRAME)
-        return np.frombuffer(imageBytes, dtype=np.int8)
+        return np.frombuffer(imageBytes, dtype=np.int8) if imageBytes is not None else None
 
     def getDetections(self, frameId):
-        return self.getFrame(frameId), json.loads(self.getData(frameId, self.DETECTIONS))
+        frameData = self.getFrameData(frameId)
+        return frameData.frame, frameData.detections
+
+    def getDetectionsOnly(self, frameId):
+        return self.getFrameData(frameId, withFrame=False).detections
+
+    def getFrameData(self, frameId, withFrame=True):
+        if not withFrame:
+            return FrameData(frameId, None, self.getData(frameId, self.DETECTIONS))
+
+        imageBytes, detectionBytes = self.call('hmget', self.redis.hmget, self.formatKey(frameId),
+                                               self.FRAME, self.DETECTIONS)
+        return FrameData(frameId, imageBytes, detectionBytes)
 
     def getData(self, frameId, hKeyName):
-        key = self.formatKey(frameId)
-        data = self.redis.hget(key, hKeyName)
-        return data
-    
+        return self.call('hget', self.redis.hget, self.formatKey(frameId), hKeyName)
+
     def getLastFrameId(self):
         return self.getLast(self.lastFrameKey)
 
@@ -52,5 +166,48 @@ class RedisClient:
         return self.getLast(self.lastDetectionKey)
 
     def getLast(self, lastKeyName):
-        id = self.redis.get(lastKeyName)
+        id = self.call('get', self.redis.get, lastKeyName)
         return int(id) if id else None
+
+    def waitForFrameId(self, timeout):
+        return self.waitForId(self.streamKeys[self.lastFrameKey], timeout)
+
+    def waitForDetectionId(self, timeout):
+        return self.waitForId(self.streamKeys[self.lastDetectionKey], timeout)
+
+    def waitForId(self, streamKey, timeout):
+        ids = waitForIds([(self, streamKey)], timeout)
+        return ids[0][1] if ids else None
+
+
+def waitForDetectionIds(clients, timeout):
+    # blocks on detection streams of several sessions at once,
+    # returns (client, detectionId, skipped, publishedAt) for every stream with new ids, see waitForIds
+    return waitForIds([(client, client.streamKeys[client.lastDetectionKey]) for client in clients], timeout)
+
+
+def waitForIds(streams, timeout):
+    # streams: (client, streamKey) pairs of clients sharing one server, read by single XREAD.
+    # First call returns the newest id already in each stream, next calls block till a new one is added.
+    # Returns (client, id, skipped, publishedAt) with the newest id of each stream, skipped counts older new ids
+    # which were passed over. Ids already in the stream before the first call are not counted. publishedAt is
+    # wall clock time of the redis server when the id was added, taken from milliseconds of the stream entry id.
+    client = streams[0][0]
+    owners = {streamKey: owner for owner, streamKey in streams}
+    cursors = {streamKey: owner.streamCursors.get(streamKey, '0') for owner, streamKey in streams}
+    if client.socketTimeout:
+        # blocked read must return before the socket times out
+        timeout = min(timeout, client.socketTimeout / 2)
+    # BLOCK 0 would wait forever
+    response = client.call('xread', client.redis.xread, cursors, block=max(int(timeout * 1000), 1))
+
+    ids = []
+    for streamKey, entries in response or []:
+        streamKey = streamKey.decode() if isinstance(streamKey, bytes) else streamKey
+        owner = owners[streamKey]
+        entryId, fields = entries[-1]
+        skipped = len(entries) - 1 if streamKey in owner.streamCursors else 0
+        owner.streamCursors[streamKey] = entryId
+        publishedAt = int((entryId.decode() if isinstance(entryId, bytes) else entryId).split('-')[0]) / 1000
+        ids.append((owner, int(fields[b'id']), skipped, publishedAt))
+    return ids
@@ -0,0 +1,114 @@
+import json
+
+import numpy as np
+
+from src.core.labels import category_map
+
+classIds = {name: classId for classId, name in category_map.items()}
+wholeFrame = [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]]
+
+
+class Rules:
+    # Rules are compiled to arrays, so all rules are evaluated against all objects of a frame at once.
+    #
+    # Rule format:
+    # {
+    #     "name": "driveway",
+    #     "classes": ["person", "car"],
+    #     "min_score": 0.5,                          optional, default 0
+    #     "min_hits": 2,                             optional, frames a tracked object must be detected in, default 1
+    #     "region": [[x, y], [x, y], [x, y], ...],   optional polygon in normalized frame coordinates, default whole frame
+    #     "session": "default-0",                    optional, camera session the rule applies to, default all
+    #     "pin": 12,
+    #     "period": 30                               seconds
+    # }
+    #
+    # Object is inside region when the bottom center of its box is inside, that is where it touches the ground.
+    edge = np.float32(1 - 1e-6)
+
+    def __init__(self, rules):
+        self.names = [rule.get('name', str(i)) for i, rule in enumerate(rules)]
+        self.pins = [int(rule['pin']) for rule in rules]
+        self.periods = [float(rule['period']) for rule in rules]
+        self.minScores = np.array([rule.get('min_score', 0.0) for rule in rules], dtype=np.float32)
+        self.minHits = np.array([rule.get('min_hits', 1) for rule in rules], dtype=np.int32)
+        self.sessions = [rule.get('session') for rule in rules]
+        self.sessionMasks = {}
+        self.classTable = self.compileClasses(rules)
+        self.regions = self.compileRegions(rules)
+        self.hasRegion = np.array([bool(rule.get('region')) for rule in rules], dtype=bool)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls(json.load(file)['rules'])
+
+    def __len__(self):
+        return len(self.pins)
+
+    def compileClasses(self, rules):
+        # classTable[rule, classId] is True if rule accepts class
+        classTable = np.zeros((len(rules), max(category_map) + 1), dtype=bool)
+        for i, rule in enumerate(rules):
+            for name in rule['classes']:
+                if name not in classIds:
+                    raise ValueError("Unknown class '{}' in rule '{}'.".format(name, self.names[i]))
+                classTable[i, classIds[name]] = True
+        return classTable
+
+    def compileRegions(self, rules):
+        # polygons are padded by repeating their last vertex, zero length edges never cross a ray
+        polygons = [np.array(rule.get('region') or wholeFrame, dtype=np.float32) for rule in rules]
+        vertices = max((len(polygon) for polygon in polygons), default=0)
+        regions = np.empty((len(rules), vertices, 2), dtype=np.float32)
+        for i, polygon in enumerate(polygons):
+            if len(polygon) < 3:
+                raise ValueError("Region of rule '{}' needs at least 3 points.".format(self.names[i]))
+            regions[i, :len(polygon)] = polygon
+            regions[i, len(polygon):] = polygon[-1]
+        return regions
+
+    def sessionMask(self, session):
+        # True for rules applying to detections of the session
+        mask = self.sessionMasks.get(session)
+        if mask is None:
+            mask = self.sessionMasks[session] = np.array(
+                [ruleSession is None or session is None or ruleSession == session for ruleSession in self.sessions],
+                dtype=bool)
+        return mask
+
+    def evaluate(self, detections, session=None):
+        # returns boolean array, True for each rule matched by at least one object
+        if detections is None or len(detections) == 0 or len(self) == 0:
+            return np.zeros(len(self), dtype=bool)
+
+        classes = detections.classes.astype(np.intp)
+        # unknown class ids match no rule
+        known = classes < self.classTable.shape[1]
+        classMask = self.classTable[:, np.where(known, classes, 0)] & known[np.newaxis, :]
+        scoreMask = detections.scores[np.newaxis, :] >= self.minScores[:, np.newaxis]
+        # objects seen by the model in a single frame only are likely false positives, untracked objects always pass
+        hitsMask = (detections.hits[np.newaxis, :] >= self.minHits[:, np.newaxis]) | (detections.trackIds == 0)[np.newaxis, :]
+
+        # boxes are clipped to the frame, points on its bottom or right edge are moved just inside,
+        # ray casting would count them as outside
+        boxes = detections.boxes
+        x = np.clip((boxes[:, 1] + boxes[:, 3]) / 2, 0, self.edge)
+        y = np.clip(boxes[:, 2], 0, self.edge)
+        # rules without region match the whole frame
+        regionMask = self.insideRegions(x, y) | ~self.hasRegion[:, np.newaxis]
+
+        return (classMask & scoreMask & hitsMask & regionMask).any(axis=1) & self.sessionMask(session)
+
+    def insideRegions(self, x, y):
+        # even-odd ray casting of all points against all polygons, result is [rule, object]
+        x1, y1 = self.regions[:, np.newaxis, :, 0], self.regions[:, np.newaxis, :, 1]
+        nextVertices = np.roll(self.regions, -1, axis=1)
+        x2, y2 = nextVertices[:, np.newaxis, :, 0], nextVertices[:, np.newaxis, :, 1]
+        px, py = x[np.newaxis, :, np.newaxis], y[np.newaxis, :, np.newaxis]
+
+        spans = (y1 > py) != (y2 > py)
+        height = np.where(y2 == y1, 1.0, y2 - y1)
+        crossX = x1 + (py - y1) * (x2 - x1) / height
+        crossings = spans & (px < crossX)
+        return crossings.sum(axis=2) % 2 == 1
@@ -0,0 +1,60 @@
+import time
+from threading import Lock
+
+
+class AdaptiveRate:
+    # Sampling period drops to 1 / maxFps while something is going on and relaxes back to idlePeriod
+    # afterwards, doubling each holdTime seconds. Average rate is limited by a token bucket: tokens are
+    # earned at budgetFps while sampling is slow and spent on bursts, so fast reaction does not raise
+    # average inference load.
+    burstTime = 300  # seconds of budget which can be saved for bursts
+
+    def __init__(self, idlePeriod, maxFps=0, holdTime=10.0, budgetFps=0, clock=time.monotonic):
+        # maxFps: 0 disables adaptation, frames are sampled each idlePeriod
+        # budgetFps: maximal average inference rate, 0 unlimited
+        self.idlePeriod = idlePeriod
+        self.minPeriod = min(1.0 / maxFps, idlePeriod) if maxFps > 0 else idlePeriod
+        self.holdTime = holdTime
+        self.budgetFps = budgetFps
+        self.clock = clock
+        self.lock = Lock()
+        self.lastActivity = None
+        self.capacity = budgetFps * self.burstTime
+        self.tokens = self.capacity
+        self.lastRefill = clock()
+
+    def activity(self):
+        # objects of interest or motion were seen
+        with self.lock:
+            self.lastActivity = self.clock()
+
+    def isActive(self):
+        with self.lock:
+            return self.lastActivity is not None and self.clock() - self.lastActivity < self.holdTime
+
+    def nextPeriod(self):
+        # period to wait before next sample, one sample is charged from the budget
+        with self.lock:
+            now = self.clock()
+            period = self.targetPeriod(now)
+            if self.budgetFps <= 0:
+                return period
+
+            self.tokens = min(self.tokens + (now - self.lastRefill) * self.budgetFps, self.capacity)
+            self.lastRefill = now
+            if self.tokens < 1:
+                # budget is spent, sample at average rate until it is earned again
+                period = max(period, 1.0 / self.budgetFps)
+            self.tokens = max(self.tokens - 1, 0)
+            return period
+
+    def targetPeriod(self, now):
+        if self.lastActivity is None:
+            return self.idlePeriod
+
+        quiet = now - self.lastActivity - self.holdTime
+        if quiet < 0:
+            return self.minPeriod
+        if self.holdTime <= 0:
+            return self.idlePeriod
+        return min(self.minPeriod * 2 ** (quiet / self.holdTime), self.idlePeriod)
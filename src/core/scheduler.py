@@ -0,0 +1,74 @@
+import time
+import heapq
+from itertools import count
+from threading import Thread, Condition
+
+
+class Scheduler:
+    # Switches outputs on immediately and off at their deadline. One thread serves all outputs.
+    # Outputs are any hashable objects with switch(on) method.
+
+    def __init__(self, listener=None):
+        # listener(output, on, lateness) is called after each transition, lateness is in seconds
+        self.listener = listener
+        self.heap = []  # (deadline, sequence, output), entries of extended deadlines are skipped lazily
+        self.deadlines = {}  # output -> current deadline of outputs which are on
+        self.sequence = count()
+        self.condition = Condition()
+        self.running = True
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def trigger(self, output, period, requestedAt=None):
+        # requestedAt: wall clock time of the event which caused the trigger, used to measure lateness
+        with self.condition:
+            deadline = time.monotonic() + period
+            current = self.deadlines.get(output)
+            if current is not None and current >= deadline:
+                return
+
+            self.deadlines[output] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.sequence), output))
+            if current is None:
+                self.transition(output, True, time.time() - requestedAt if requestedAt else 0.0)
+            self.condition.notify()
+
+    def isOn(self, output):
+        with self.condition:
+            return output in self.deadlines
+
+    def run(self):
+        with self.condition:
+            while self.running:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                deadline, _, output = self.heap[0]
+                now = time.monotonic()
+                if deadline > now:
+                    self.condition.wait(deadline - now)
+                    continue
+
+                heapq.heappop(self.heap)
+                if self.deadlines.get(output) != deadline:
+                    continue
+
+                del self.deadlines[output]
+                self.transition(output, False, now - deadline)
+
+    def transition(self, output, on, lateness):
+        output.switch(on)
+        if self.listener:
+            self.listener(output, on, lateness)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            for output in list(self.deadlines):
+                self.transition(output, False, 0.0)
+            self.deadlines.clear()
+            self.heap = []
+            self.condition.notify()
+        self.thread.join()
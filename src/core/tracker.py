@@ -0,0 +1,172 @@
+import numpy as np
+import cv2
+
+from src.core.detections import Detections
+
+# OpenCV trackers from opencv-contrib-python, moved to cv2.legacy in OpenCV 4.5.1
+cvTrackers = {'kcf': 'TrackerKCF_create', 'csrt': 'TrackerCSRT_create', 'mosse': 'TrackerMOSSE_create'}
+methods = ['iou'] + list(cvTrackers)
+
+
+def iou(boxes1, boxes2):
+    # pairwise intersection over union of [N, 4] and [M, 4] boxes [ymin, xmin, ymax, xmax], result is [N, M]
+    top = np.maximum(boxes1[:, np.newaxis, 0], boxes2[np.newaxis, :, 0])
+    left = np.maximum(boxes1[:, np.newaxis, 1], boxes2[np.newaxis, :, 1])
+    bottom = np.minimum(boxes1[:, np.newaxis, 2], boxes2[np.newaxis, :, 2])
+    right = np.minimum(boxes1[:, np.newaxis, 3], boxes2[np.newaxis, :, 3])
+    intersection = np.clip(bottom - top, 0, None) * np.clip(right - left, 0, None)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1[:, np.newaxis] + area2[np.newaxis, :] - intersection
+    return np.where(union > 0, intersection / np.maximum(union, 1e-9), 0.0)
+
+
+def centers(boxes):
+    return np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1)
+
+
+def createCvTracker(method):
+    name = cvTrackers[method]
+    factory = getattr(getattr(cv2, 'legacy', cv2), name, None) or getattr(cv2, name, None)
+    if factory is None:
+        raise ValueError("Tracker '{}' requires opencv-contrib-python.".format(method))
+    return factory()
+
+
+class Tracker:
+    # Keeps ids of objects between detections. Detections are matched to tracks of the same class by IoU
+    # with the predicted track box, boxes which do not overlap are matched by distance of their centers.
+    # Between detections boxes are moved by their last velocity, or by OpenCV trackers when method is not 'iou'.
+    iouThreshold = 0.3
+    maxDistance = 0.1  # of frame size
+    maxMissed = 2  # detections in a row, then the track is removed
+
+    def __init__(self, method='iou'):
+        if method != 'iou':
+            createCvTracker(method)
+        self.method = method
+        self.nextId = 1
+        self.ids = np.empty(0, dtype=Detections.trackType)
+        self.classes = np.empty(0, dtype=Detections.classType)
+        self.scores = np.empty(0, dtype=Detections.scoreType)
+        self.boxes = np.empty((0, 4), dtype=Detections.boxType)
+        self.velocities = np.empty((0, 4), dtype=Detections.boxType)  # box change per second
+        self.timestamps = np.empty(0)
+        self.hits = np.empty(0, dtype=Detections.hitsType)
+        self.missed = np.empty(0, dtype=int)
+        self.cvTrackers = []
+        self.lost = False  # some OpenCV tracker lost its object, next frame should be detected
+
+    def __len__(self):
+        return len(self.ids)
+
+    def update(self, detections, frame, timestamp):
+        # associates new detections with tracks, returns detections with track ids
+        predicted = self.predictBoxes(timestamp)
+        trackIndex, detectionIndex = self.associate(detections, predicted)
+
+        matched = np.zeros(len(self), dtype=bool)
+        matched[trackIndex] = True
+        elapsed = np.maximum(timestamp - self.timestamps[trackIndex], 1e-3)[:, np.newaxis]
+        self.velocities[trackIndex] = (detections.boxes[detectionIndex] - self.boxes[trackIndex]) / elapsed
+        self.boxes[trackIndex] = detections.boxes[detectionIndex]
+        self.scores[trackIndex] = detections.scores[detectionIndex]
+        self.timestamps[trackIndex] = timestamp
+        self.hits[trackIndex] = np.minimum(self.hits[trackIndex].astype(int) + 1, np.iinfo(Detections.hitsType).max)
+        self.missed[trackIndex] = 0
+        self.missed[~matched] += 1
+
+        keep = self.missed <= self.maxMissed
+        trackIds = np.zeros(len(detections), dtype=Detections.trackType)
+        trackIds[detectionIndex] = self.ids[trackIndex]
+        self.removeTracks(keep)
+
+        new = np.ones(len(detections), dtype=bool)
+        new[detectionIndex] = False
+        trackIds[new] = self.addTracks(detections, new, timestamp)
+
+        if self.method != 'iou':
+            self.startCvTrackers(frame)
+        hits = self.hits[np.searchsorted(self.ids, trackIds)]
+        return Detections(detections.classes, detections.scores, detections.boxes, trackIds, hits)
+
+    def predict(self, frame, timestamp):
+        # tracked objects in a frame which was not analyzed by the model
+        if self.method == 'iou':
+            boxes = self.predictBoxes(timestamp)
+        else:
+            boxes = self.updateCvTrackers(frame, timestamp)
+        # only tracks confirmed by the last detection keep their hits, a rule must not fire on a track
+        # which the model did not see since
+        hits = np.where(self.missed == 0, self.hits, 0)
+        return Detections(self.classes, self.scores, np.clip(boxes, 0, 1), self.ids, hits)
+
+    def predictBoxes(self, timestamp):
+        return self.boxes + self.velocities * (timestamp - self.timestamps)[:, np.newaxis]
+
+    def associate(self, detections, predicted):
+        # greedy matching, best pairs first, returns matched track and detection indices
+        if len(self) == 0 or len(detections) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        overlaps = iou(predicted, detections.boxes)
+        distances = np.linalg.norm(centers(predicted)[:, np.newaxis] - centers(detections.boxes)[np.newaxis], axis=2)
+        # close boxes without enough overlap are still better than nothing, but worse than any overlap
+        scores = np.where(overlaps >= self.iouThreshold, 1 + overlaps,
+                          np.where(distances < self.maxDistance, 1 - distances / self.maxDistance, 0))
+        scores[self.classes[:, np.newaxis] != detections.classes[np.newaxis, :]] = 0
+
+        trackIndex, detectionIndex = [], []
+        usedTracks, usedDetections = set(), set()
+        for flat in np.argsort(-scores, axis=None):
+            track, detection = divmod(int(flat), scores.shape[1])
+            if scores[track, detection] <= 0:
+                break
+            if track in usedTracks or detection in usedDetections:
+                continue
+            usedTracks.add(track)
+            usedDetections.add(detection)
+            trackIndex.append(track)
+            detectionIndex.append(detection)
+        return np.array(trackIndex, dtype=int), np.array(detectionIndex, dtype=int)
+
+    def removeTracks(self, keep):
+        self.ids, self.classes, self.scores = self.ids[keep], self.classes[keep], self.scores[keep]
+        self.boxes, self.velocities = self.boxes[keep], self.velocities[keep]
+        self.timestamps, self.hits, self.missed = self.timestamps[keep], self.hits[keep], self.missed[keep]
+
+    def addTracks(self, detections, new, timestamp):
+        count = int(np.count_nonzero(new))
+        ids = np.arange(self.nextId, self.nextId + count, dtype=Detections.trackType)
+        self.nextId += count
+        # ids grow, so the arrays stay sorted by id
+        self.ids = np.concatenate([self.ids, ids])
+        self.classes = np.concatenate([self.classes, detections.classes[new]])
+        self.scores = np.concatenate([self.scores, detections.scores[new]])
+        self.boxes = np.concatenate([self.boxes, detections.boxes[new]])
+        self.velocities = np.concatenate([self.velocities, np.zeros((count, 4), dtype=Detections.boxType)])
+        self.timestamps = np.concatenate([self.timestamps, np.full(count, timestamp)])
+        self.hits = np.concatenate([self.hits, np.ones(count, dtype=Detections.hitsType)])
+        self.missed = np.concatenate([self.missed, np.zeros(count, dtype=int)])
+        return ids
+
+    def startCvTrackers(self, frame):
+        height, width = frame.shape[:2]
+        self.cvTrackers = []
+        for ymin, xmin, ymax, xmax in self.boxes * np.array([height, width, height, width]):
+            tracker = createCvTracker(self.method)
+            tracker.init(frame, (int(xmin), int(ymin), max(int(xmax - xmin), 1), max(int(ymax - ymin), 1)))
+            self.cvTrackers.append(tracker)
+        self.lost = False
+
+    def updateCvTrackers(self, frame, timestamp):
+        # tracked boxes are kept, next detections are matched against them
+        height, width = frame.shape[:2]
+        for i, tracker in enumerate(self.cvTrackers):
+            ok, (x, y, w, h) = tracker.update(frame)
+            if not ok:
+                self.lost = True
+                continue
+            self.boxes[i] = (y / height, x / width, (y + h) / height, (x + w) / width)
+            self.timestamps[i] = timestamp
+        return self.boxes
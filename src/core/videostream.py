@@ -1,15 +1,37 @@
 import time
-from threading import Thread
+from collections import namedtuple
+from threading import Thread, Condition, current_thread
 
 import cv2
+import ffmpeg
+import numpy as np
+
+from src.core import metrics
+
+Frame = namedtuple('Frame', ['sequence', 'timestamp', 'image'])
+
+framesCaptured = metrics.counter('videostream_frames_captured_total', "Frames decoded from video stream.", ['stream'])
+reconnects = metrics.counter('videostream_reconnects_total', "Attempts to (re)connect video stream.", ['stream'])
+watchdogTrips = metrics.counter('videostream_watchdog_trips_total', "Reconnects caused by too many empty frames.", ['stream'])
+
 
 class VideoStream:
     max_empty_frames = 5
+    # Frames are decoded into preallocated ring slots. Returned images are views into the ring
+    # and stay valid until slots-1 newer frames are captured, copy them to keep them longer.
+    slots = 4
+    releaseTimeout = 2  # seconds to wait for capture thread stuck in read or open
 
-    def __init__(self, stream):
+    def __init__(self, stream, name='default'):
+        # name identifies stream in metrics, stream URL may contain credentials
         self.stream = stream
+        self.name = name
         self.capture = None
+        self.buffers = [None] * self.slots
         self.frame = None
+        self.sequence = 0
+        self.lastReadSequence = 0
+        self.condition = Condition()
         self.canceled = False
         self.watchdog = 0
         self.thread = Thread(target=self.readStream, args=())
@@ -22,8 +44,17 @@ class VideoStream:
 
         if self.capture:
             self.capture.release()
+            self.capture = None
+
+        reconnects.inc(self.name)
+        try:
+            self.capture = self.openCapture()
+        except Exception as ex:
+            # e.g. missing ffmpeg binary or failed probe, retried as a stream which did not open
+            print("Can not open stream: {}".format(str(ex)))
+            time.sleep(1)
+            return
 
-        self.capture = cv2.VideoCapture(self.stream)
         if not self.capture.isOpened():
             print("Can not open stream")
             time.sleep(1)
@@ -31,6 +62,9 @@ class VideoStream:
             print("Successfully connected to Stream '{}'.".format(self.stream))
             self.tick()
 
+    def openCapture(self):
+        return cv2.VideoCapture(self.stream)
+
     def readStream(self):
         try:
             while True:
@@ -40,26 +74,137 @@ class VideoStream:
                 self.watchdog = self.watchdog + 1
 
                 if self.shouldReconnectStream():
+                    if self.watchdog == self.max_empty_frames:
+                        watchdogTrips.inc(self.name)
                     print("Stream is closed. Connecting ...")
                     self.connect()
                 else:
-                    (self.status, self.frame) = self.capture.read()
-                    
-                    if self.frame is not None:
-                        self.tick() 
+                    index = (self.sequence + 1) % self.slots
+                    buffer = self.buffers[index]
+                    (self.status, image) = self.capture.read(buffer) if buffer is not None else self.capture.read()
+
+                    if self.status and image is not None:
+                        # capture reallocates only when resolution changes
+                        self.buffers[index] = image
+                        self.publish(image)
+                        self.tick()
 
         except Exception as ex:
             print("Error in video stream thread: {}".format(str(ex)))
+        finally:
+            # released here, releasing from another thread while reading crashes the capture
+            if self.capture:
+                self.capture.release()
+
+    def publish(self, image):
+        with self.condition:
+            self.sequence += 1
+            self.frame = Frame(self.sequence, time.time(), image)
+            self.condition.notify_all()
+        framesCaptured.inc(self.name)
 
     def read(self):
-        return self.frame
+        frame = self.frame
+        if frame is None:
+            return None
+        self.lastReadSequence = frame.sequence
+        return frame.image
+
+    def read_new(self, timeout=None, after=None):
+        after = self.lastReadSequence if after is None else after
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence > after or self.canceled, timeout):
+                return None
+            frame = self.frame
+
+        if frame is None or frame.sequence <= after:
+            return None
+        self.lastReadSequence = frame.sequence
+        return frame
 
     def release(self):
         self.canceled = True
-        self.capture.release()
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is current_thread():
+            return
+        self.thread.join(self.releaseTimeout)
+        if self.thread.is_alive():
+            # thread is blocked in read or open, releasing the capture unblocks it
+            print("Video stream thread did not stop, releasing capture.")
+            capture = self.capture
+            if capture:
+                capture.release()
 
     def shouldReconnectStream(self):
         return self.capture is None or not self.capture.isOpened() or self.watchdog == self.max_empty_frames
 
     def tick(self):
-        self.watchdog = 0
\ No newline at end of file
+        self.watchdog = 0
+
+
+class FFmpegCapture:
+    # cv2.VideoCapture compatible reader of raw frames decoded, decimated and scaled by ffmpeg
+
+    def __init__(self, stream, size=None, fps=0, keyframesOnly=False, hwaccel=None):
+        inputArgs = {}
+        if isinstance(stream, int):
+            stream, inputArgs['format'] = '/dev/video{}'.format(stream), 'v4l2'
+        elif stream.startswith('rtsp://'):
+            inputArgs['rtsp_transport'] = 'tcp'
+        if keyframesOnly:
+            inputArgs['skip_frame'] = 'nokey'
+        if hwaccel:
+            inputArgs['hwaccel'] = hwaccel
+
+        width, height = size if size else self.probeSize(stream)
+        self.shape = (height, width, 3)
+
+        video = ffmpeg.input(stream, **inputArgs)
+        if fps > 0:
+            video = video.filter('fps', fps=fps)
+        if size:
+            video = video.filter('scale', width, height)
+        self.process = video.output('pipe:', format='rawvideo', pix_fmt='bgr24') \
+                            .global_args('-loglevel', 'error') \
+                            .run_async(pipe_stdout=True)
+
+    def probeSize(self, stream):
+        info = ffmpeg.probe(stream)
+        video = next(s for s in info['streams'] if s['codec_type'] == 'video')
+        return int(video['width']), int(video['height'])
+
+    def isOpened(self):
+        return self.process.poll() is None
+
+    def read(self, image=None):
+        if image is None or image.shape != self.shape:
+            image = np.empty(self.shape, dtype=np.uint8)
+
+        # frame is read straight into the image memory
+        view = memoryview(image.reshape(-1))
+        received = 0
+        while received < len(view):
+            count = self.process.stdout.readinto(view[received:])
+            if not count:
+                return False, None
+            received += count
+        return True, image
+
+    def release(self):
+        if self.isOpened():
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class FFmpegVideoStream(VideoStream):
+    def __init__(self, stream, size=None, fps=0, keyframesOnly=False, hwaccel=None, name='default'):
+        self.size = size
+        self.fps = fps
+        self.keyframesOnly = keyframesOnly
+        self.hwaccel = hwaccel
+        super().__init__(stream, name)
+
+    def openCapture(self):
+        return FFmpegCapture(self.stream, self.size, self.fps, self.keyframesOnly, self.hwaccel)
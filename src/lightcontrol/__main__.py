@@ -1,106 +1,137 @@
 import time
 from datetime import datetime
-from threading import Thread
 
 import argparse
+from redis.exceptions import RedisError
 
-from src.core.redisclient import RedisClient
+from src.core.rules import Rules
+from src.core.redisclient import RedisClient, waitForDetectionIds
 from src.core.nighttime import NightTime
+from src.core.scheduler import Scheduler
+from src.core import metrics
 
 NA_GPIO = -1
-hour = 3600 # seconds
+detectionTimeout = 10 # seconds
+redisErrorDelay = 5 # seconds
 
 parser = argparse.ArgumentParser(description="Turn on lights if person/car/bicycle is detected.")
 parser.add_argument('-r', '--redis-server', metavar='server:port', type=str, default='redis:6379',
-                    help="URL to redis server. Default 'redis:6379'.")
-parser.add_argument('-s', '--session', metavar='session-name', type=str, default='default',
-                    help="Session identification. Frames will be stored in redis under 'session-name:key'."
-                    "Default 'default'.")
+                    help="URL to redis server, or path to its unix socket as 'unix:///path/redis.sock'. Default 'redis:6379'.")
+parser.add_argument('--redis-timeout', metavar='N.N', type=float, default=5.0,
+                    help="Redis socket timeout in seconds. Default 5.")
+parser.add_argument('--redis-retries', metavar='N', type=int, default=3,
+                    help="How many times to retry redis operation after connection error. Default 3.")
+parser.add_argument('-s', '--session', metavar='session-name', type=str, nargs='+', default=['default'],
+                    help="Sessions to read detections from, one per camera. Detections are read from redis under"
+                    " 'session-name:key'. Default 'default'.")
 parser.add_argument('-d', '--debug', action='store_true', help="Write debug messages to console.")
-parser.add_argument('-p', '--period', type=int, default=5, help="For how long should be the lights on.")
+parser.add_argument('--metrics-port', metavar='N', type=int, default=0,
+                    help="Serve Prometheus metrics on http://host:N/metrics. Default 0 (disabled).")
+parser.add_argument('--latitude', metavar='N.N', type=float, default=NightTime.latitude,
+                    help="Latitude of the camera, used to compute sunset. Default {}.".format(NightTime.latitude))
+parser.add_argument('--longitude', metavar='N.N', type=float, default=NightTime.longitude,
+                    help="Longitude of the camera, used to compute sunset. Default {}.".format(NightTime.longitude))
+parser.add_argument('-p', '--period', type=float, default=5, help="For how long (in seconds) should be the lights on.")
 parser.add_argument('-c', '--control-pin', metavar='N', type=int, default=NA_GPIO,
                     help='Pin for light control. Value specifies output GPIO. \
                         If set to High, lights are on. Default {0} (do not use).'.format(NA_GPIO))
+parser.add_argument('--rules', metavar='rules.json', type=str, default=None,
+                    help="JSON file with rules mapping detected classes, scores and regions to light outputs."
+                    " Without it, --control-pin is switched for --period seconds when person, car or bicycle is detected.")
 
 args = parser.parse_args()
 print("Arguments:")
 print(args)
 
-if args.control_pin > NA_GPIO:
+# objects of interes
+OOI = ['person', 'car', 'bicycle']
+rules = Rules.load(args.rules) if args.rules else Rules([{'name': 'default', 'classes': OOI, 'pin': args.control_pin, 'period': args.period}])
+
+if any(pin > NA_GPIO for pin in rules.pins):
     import Jetson.GPIO as GPIO
 
     GPIO.setmode(GPIO.BOARD)
-    pin = args.control_pin
-    GPIO.setup(pin, GPIO.OUT)
 
-# objects of interes
-OOI = ['person', 'car', 'bicycle']
-hasRelevantObject = lambda detections: detections is not None and 0 < len([v for _, v in detections.items() if v['class'] in OOI])
+detectionsConsumed = metrics.counter('lightcontrol_detections_consumed_total', "New detections read from redis.")
+detectionsSkipped = metrics.counter('lightcontrol_detections_skipped_total', "Detections not evaluated, because already consumed or newer ones were waiting.")
+lightTransitions = metrics.counter('lightcontrol_light_transitions_total', "Light switched on or off.", ['pin', 'state'])
+lightOnSeconds = metrics.counter('lightcontrol_light_on_seconds_total', "Time lights were on.", ['pin'])
+transitionLateness = metrics.histogram('lightcontrol_transition_lateness_seconds', "How late light was switched.", ['state'])
 
 def debug(text):
     if args.debug:
         print("{}: {}".format(datetime.utcnow(), text))
 
-def next_detection(redis):
-    detectionId = redis.getLastDetectionId()
+class DetectionFeed:
+    def __init__(self, clients):
+        self.clients = clients
+        self.lastDetectionIds = {}
+        self.consumed = 0
+        self.skipped = 0
+
+    def next_detections(self):
+        # returns (session, detections, publishedAt) for every session with new detections
+        results = []
+        for redis, detectionId, skipped, publishedAt in waitForDetectionIds(self.clients, detectionTimeout):
+            # detections written while previous ones were processed are never evaluated
+            if skipped:
+                self.skipped += skipped
+                detectionsSkipped.inc(amount=skipped)
+            if detectionId == self.lastDetectionIds.get(redis.session):
+                self.skipped += 1
+                detectionsSkipped.inc()
+                continue
 
-    if detectionId is None:
-        return None
-    
-    _, detections = redis.getDetections(detectionId)
-    
-    return detections
+            self.lastDetectionIds[redis.session] = detectionId
+            self.consumed += 1
+            detectionsConsumed.inc()
+            # image is not needed for decision, fetch detections only
+            results.append((redis.session, redis.getDetectionsOnly(detectionId), publishedAt))
+        return results
 
 def wait_routine(nightTime):
-    secondsTillNight = nightTime.secondsTillNight()
-    delay = secondsTillNight if secondsTillNight < hour  else hour
+    delay = nightTime.secondsTillTransition()
     debug("Hey, it's a day! I'll take a nap for {0} seconds ...".format(delay))
     time.sleep(delay)
 
-class Timer:
-    def __init__(self, defaultPeriodInSeconds, gpio):
-        self.defaultPeriod = defaultPeriodInSeconds
-        self.currentPeriod = self.defaultPeriod
+class Light:
+    def __init__(self, gpio):
         self.gpio = gpio
-        self.running = False
-        self.thread = None
+        self.onSince = None
         if self.gpio > NA_GPIO:
            GPIO.setup(self.gpio, GPIO.OUT)
 
-    def run(self):
-        debug("Lights on!")
-        self.set_output(GPIO.HIGH)
-        while self.running and self.currentPeriod:
-            time.sleep(1)
-            self.currentPeriod -= 1
-        self.set_output(GPIO.LOW)
-        debug("Lights off!")
-
-    def start(self):
-        self.running = True
-        self.currentPeriod = self.defaultPeriod
-
-        if self.thread is None or not self.thread.is_alive():
-            self.thread = Thread(target=self.run, args=())
-            self.thread.daemon = True
-            self.thread.start()
-
-    def stop(self):
-        self.running = False
-        self.currentPeriod = 0
-        if self.thread:
-            self.thread.join()            
-        pass
-
-    def set_output(self, value):
+    def switch(self, on):
         if self.gpio > NA_GPIO:
-            GPIO.output(pin, value)
+            GPIO.output(self.gpio, GPIO.HIGH if on else GPIO.LOW)
+
+        if on:
+            self.onSince = time.monotonic()
+        elif self.onSince is not None:
+            lightOnSeconds.inc(self.gpio, amount=time.monotonic() - self.onSince)
+            self.onSince = None
+
+    def __repr__(self):
+        return "Light(gpio={})".format(self.gpio)
+
+
+def log_transition(light, on, lateness):
+    state = "on" if on else "off"
+    lightTransitions.inc(light.gpio, state)
+    transitionLateness.observe(lateness, state)
+    debug("{} {}! {:.1f} ms late.".format(light, state, lateness * 1000))
 
 def main():
-    timer = Timer(args.period, args.control_pin)
-    redis = RedisClient(args.redis_server)
-    nightTime = NightTime()
-    debug("Successfully connected to Redis.")
+    lights = {pin: Light(pin) for pin in set(rules.pins)}
+    scheduler = Scheduler(log_transition)
+    clients = [RedisClient(args.redis_server, session, socketTimeout=args.redis_timeout, retries=args.redis_retries)
+               for session in args.session]
+    clients[0].ping()
+    feed = DetectionFeed(clients)
+    nightTime = NightTime(args.latitude, args.longitude)
+    debug("Successfully connected to Redis. Sessions: {}.".format(', '.join(args.session)))
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
 
     try:
         while True:
@@ -108,21 +139,29 @@ def main():
                 wait_routine(nightTime)
                 continue
 
-            detections = next_detection(redis)
+            try:
+                newDetections = feed.next_detections()
+            except RedisError as e:
+                # retries are exhausted, keep lights scheduled and try again later
+                print("Redis is not available: {}".format(str(e)), flush=True)
+                time.sleep(redisErrorDelay)
+                continue
 
-            if detections is None or len(detections) == 0:
-                debug("New detection not available")
-                time.sleep(10)
+            if not any(detections is not None and len(detections) for _, detections, _ in newDetections):
+                debug("New detection not available. Consumed {}, skipped {} detections.".format(feed.consumed, feed.skipped))
                 continue
-            
-            if hasRelevantObject(detections):
-                timer.start()
+
+            for session, detections, publishedAt in newDetections:
+                for i in rules.evaluate(detections, session).nonzero()[0]:
+                    debug("Rule '{}' matched in session '{}'.".format(rules.names[i], session))
+                    # lateness of switching on is measured from publishing of the detections
+                    scheduler.trigger(lights[rules.pins[i]], rules.periods[i], publishedAt)
 
     except Exception as e:
         print(str(e))
     finally:
-        debug("Exiting...")        
-        timer.stop()
+        debug("Exiting...")
+        scheduler.stop()
 
 
 if __name__ == '__main__':
@@ -5,37 +5,145 @@ from os import path
 import numpy as np
 import cv2
 import argparse
- 
-import tensorflow as tf
 
-from src.core.labels import category_index
+from src.core.detections import Detections
 from src.core.redisclient import RedisClient
-from src.core.videostream import VideoStream
+from src.core.videostream import VideoStream, FFmpegVideoStream
 from src.core.nighttime import NightTime
+from src.core.pipeline import Pipeline
+from src.core.motion import MotionGate
+from src.core.sampling import AdaptiveRate
+from src.core.tracker import Tracker, methods as trackerMethods
+from src.core import metrics
+from src.core.rules import classIds
+from src.objectdetector.backends import backends, allowedClasses, createBackend, warmUp
+from src.objectdetector.storage import formats, FrameStorage
+from src.objectdetector.tiling import Tiler
 
 hour = 3600  # seconds
 
 parser = argparse.ArgumentParser(description="Analyze frames and estimate object type using tensorflow.")
-parser.add_argument('-i', '--input', metavar='http://my.video.source.com/', type=str, default='0',
-                    help="Source can be id of connected web camera or stream URL. Default '0' (internal web camera id).")
+parser.add_argument('-i', '--input', metavar='http://my.video.source.com/', type=str, nargs='+', default=['0'],
+                    help="Source can be id of connected web camera or stream URL. Multiple sources can be given,"
+                    " their frames are analyzed together in one batch. Default '0' (internal web camera id).")
 parser.add_argument('--delay', metavar='N.N', type=float, default=1.0,
                     help="Delay between two images. No need to have all captured frames. Sample: value=2.0 will add image each 2 seconds."
                     " Default 1.0 .")
 parser.add_argument('-r', '--redis-server', metavar='server:port', type=str, default='redis:6379',
-                    help="URL to redis server. Default 'redis:6379'.")
-parser.add_argument('-s', '--session', metavar='session-name', type=str, default='default',
+                    help="URL to redis server, or path to its unix socket as 'unix:///path/redis.sock'. Default 'redis:6379'.")
+parser.add_argument('--redis-timeout', metavar='N.N', type=float, default=5.0,
+                    help="Redis socket timeout in seconds. Default 5.")
+parser.add_argument('--redis-retries', metavar='N', type=int, default=3,
+                    help="How many times to retry redis operation after connection error. Default 3.")
+parser.add_argument('-s', '--session', metavar='session-name', type=str, nargs='+', default=['default'],
                     help="Session identification. Frames will be stored in redis under 'session-name:key'."
-                    "Default 'default'.")
+                    " Give one session per input, or a single one to use 'session-name-N' for N-th input."
+                    " Default 'default'.")
 parser.add_argument('-d', '--debug', action='store_true', help="Write debug messages to console.")
 parser.add_argument("-m", "--saved-model", type=str, default="/data/saved_model", help="Pre-trained model to load.")
+parser.add_argument("-b", "--backend", choices=backends, default='savedmodel',
+                    help="Inference backend. 'savedmodel' runs --saved-model in tensorflow, 'tensorrt' converts it"
+                    " with TF-TRT and caches the result in --trt-cache, 'onnx' runs --onnx-model on CPU. Default 'savedmodel'.")
+parser.add_argument("--trt-cache", metavar='directory', type=str, default="/data/trt_cache",
+                    help="Directory for TensorRT converted models. Default '/data/trt_cache'.")
+parser.add_argument("--trt-precision", choices=['FP32', 'FP16', 'INT8'], default='FP16', help="TensorRT precision. Default 'FP16'.")
+parser.add_argument("--onnx-model", metavar='model.onnx', type=str, default=None, help="ONNX model for 'onnx' backend.")
 parser.add_argument("-t", "--threshold", type=float, default=0.5, help="Minimum detection threshold to use")
+parser.add_argument('--latitude', metavar='N.N', type=float, default=NightTime.latitude,
+                    help="Latitude of the camera, used to compute sunset. Default {}.".format(NightTime.latitude))
+parser.add_argument('--longitude', metavar='N.N', type=float, default=NightTime.longitude,
+                    help="Longitude of the camera, used to compute sunset. Default {}.".format(NightTime.longitude))
+parser.add_argument("--classes", metavar='name', type=str, nargs='+', default=None,
+                    help="Report only these classes, e.g. 'person car'. Default all classes.")
+parser.add_argument("--metrics-port", metavar='N', type=int, default=0,
+                    help="Serve Prometheus metrics on http://host:N/metrics. Default 0 (disabled).")
 parser.add_argument("-f", "--run-at-day", action='store_true', help="Run during day, not only at night")
+parser.add_argument("--queue-size", metavar='N', type=int, default=2,
+                    help="Size of queues between pipeline stages. When a stage falls behind, the oldest frames are dropped."
+                    " Default 2.")
+parser.add_argument("--stats-interval", metavar='N.N', type=float, default=60.0,
+                    help="How often (in seconds) to print pipeline throughput and queue depth in debug mode. Default 60.0 .")
+parser.add_argument("--input-size", metavar='N', type=int, default=320,
+                    help="Frames of different resolution are resized to NxN before they are batched together."
+                    " Also the size of frames produced by '--decoder ffmpeg', unless --regions or --tile-size is given."
+                    " Default 320.")
+
+parser.add_argument("--motion-threshold", metavar='N.N', type=float, default=0.0,
+                    help="Minimal fraction of changed pixels between frames to run detection. Frames of a static scene"
+                    " are skipped. Default 0.0 (analyze every frame).")
+parser.add_argument("--motion-refresh", metavar='N.N', type=float, default=60.0,
+                    help="Analyze a frame at least each N seconds even if the scene did not change. Default 60.0 .")
+
+parser.add_argument("--max-fps", metavar='N.N', type=float, default=0.0,
+                    help="Sample up to N frames per second while objects or motion are seen, then slow down back"
+                    " to one frame per --delay. Default 0 (always one frame per --delay).")
+parser.add_argument("--active-hold", metavar='N.N', type=float, default=10.0,
+                    help="Keep sampling at --max-fps for N seconds after the last activity, then halve the rate each"
+                    " N seconds. Default 10.0 .")
+parser.add_argument("--inference-budget", metavar='N.N', type=float, default=0.0,
+                    help="Maximal average number of inferences per second, faster sampling is paid by slower sampling"
+                    " later. Default 0 (unlimited).")
+
+parser.add_argument("--detect-every", metavar='N', type=int, default=1,
+                    help="Run the model on every N-th sampled frame only, objects are tracked in frames between."
+                    " The model also runs when a tracker loses its object. Default 1 (every frame).")
+parser.add_argument("--tracker", choices=trackerMethods, default='iou',
+                    help="How objects are followed between detections. 'iou' moves boxes by their last velocity,"
+                    " others use OpenCV trackers from opencv-contrib-python. Default 'iou'.")
+
+parser.add_argument("--regions", metavar='regions.json', type=str, default=None,
+                    help="JSON file with regions of interest per session. Only these regions of frames are analyzed."
+                    " Default analyze whole frames.")
+parser.add_argument("--tile-size", metavar='N', type=int, default=0,
+                    help="Split regions (or whole frames) bigger than NxN pixels into overlapping tiles. Tiles are"
+                    " analyzed in one batch by backends with dynamic batch size, models exported by TF object detection"
+                    " API accept a single frame and run one call per tile. Default 0 (no tiling).")
+parser.add_argument("--tile-overlap", metavar='N.N', type=float, default=0.2,
+                    help="Fraction of a tile overlapping its neighbour. Default 0.2 .")
+
+parser.add_argument("--decoder", choices=['opencv', 'ffmpeg'], default='opencv',
+                    help="'opencv' decodes every frame of the stream. 'ffmpeg' decodes only about two frames per --delay"
+                    " and scales them to --input-size inside the decoder. Default 'opencv'.")
+parser.add_argument("--keyframes-only", action='store_true', help="Decode only key frames. Requires '--decoder ffmpeg'.")
+parser.add_argument("--hwaccel", metavar='method', type=str, default=None,
+                    help="FFmpeg hardware decoding method, e.g. 'cuda'. Requires '--decoder ffmpeg'.")
+
+parser.add_argument("--frame-format", choices=list(formats), default='jpeg',
+                    help="Format of frames stored in redis for the visualizer, 'none' stores detections only. Default 'jpeg'.")
+parser.add_argument("--frame-quality", metavar='N', type=int, default=95,
+                    help="Quality (0-100) of stored frames. Default 95.")
+parser.add_argument("--frame-width", metavar='N', type=int, default=0,
+                    help="Store frames downscaled to N pixels wide thumbnails. Default 0 (full resolution).")
+parser.add_argument("--store-only-detected", action='store_true',
+                    help="Store frames only when something was detected. Detections are published for every frame.")
 
 
 args = parser.parse_args()
 print("Arguments:")
 print(args, flush=True)
 
+if len(args.session) == 1 and len(args.input) > 1:
+    args.session = ['{}-{}'.format(args.session[0], i) for i in range(len(args.input))]
+elif len(args.session) != len(args.input):
+    parser.error("Number of sessions ({}) does not match number of inputs ({}).".format(len(args.session), len(args.input)))
+
+unknownClasses = set(args.classes or []) - set(classIds)
+if unknownClasses:
+    parser.error("Unknown classes: {}.".format(", ".join(sorted(unknownClasses))))
+if args.delay < 0:
+    parser.error("--delay must not be negative.")
+
+framesTracked = metrics.counter('objectdetector_frames_tracked_total', "Frames analyzed by tracker instead of the model.", ['session'])
+inferenceSeconds = metrics.histogram('objectdetector_inference_seconds', "Duration of one inference call.", ['backend'])
+framesSkipped = metrics.counter('objectdetector_frames_skipped_total', "Frames skipped by motion gate.", ['session'])
+framesProcessed = metrics.counter('objectdetector_frames_processed_total', "Frames sent to inference.", ['session'])
+detectionsPublished = metrics.counter('objectdetector_detections_total', "Published detections by class.", ['session', 'class'])
+samplingRate = metrics.gauge('objectdetector_sampling_rate_fps', "Current frame sampling rate, 0 when frames are sampled without delay.")
+firstDetectionLatency = metrics.histogram('objectdetector_first_detection_latency_seconds',
+                                          "Time from capture to publishing of the first detection after a quiet period.",
+                                          ['session'])
+framesStored = metrics.counter('objectdetector_frames_stored_total', "Frames encoded and stored for visualizer.", ['session'])
+
 
 def debug(text):
     if args.debug:
@@ -46,101 +154,257 @@ def file_not_found(file):
     print("Can not find file '{}'.".format(file))
 
 
-def toDetectionDict(rawDetections):
-    num_detections = int(rawDetections.pop('num_detections'))
-    detections = {key: value[0, :num_detections].numpy()
-                for key, value in rawDetections.items()}
-    
-    detections['detection_classes'] = detections['detection_classes'].astype(np.int64)
-    scores = np.squeeze(detections["detection_scores"])
-    boxes = np.squeeze(detections["detection_boxes"])[scores>args.threshold].tolist()
-    classes = np.squeeze(detections["detection_classes"])[scores>args.threshold]
-    scores = scores[scores>args.threshold].tolist()
-    categories = [category_index[idx]['name'] for idx in classes]
-    
-    debug("Detected {} objects in image: {}".format(len(scores), categories))
+modelFile = args.onnx_model if args.backend == 'onnx' else args.saved_model
+if modelFile is None or not path.exists(modelFile):
+    file_not_found(modelFile)
+    parser.exit(1)
 
-    detectionsDict = {i: {"class":categories[i], "score":scores[i], "box":boxes[i]} for i in range(0, len(scores))}
-    return detectionsDict
 
+def toDetections(rawDetections, batchSize):
+    # detections are ordered by image, one split gives detections of each camera
+    bounds = np.searchsorted(rawDetections['image_index'], np.arange(1, batchSize))
+    columns = [np.split(rawDetections[key], bounds) for key in ['detection_classes', 'detection_scores', 'detection_boxes']]
 
-def connectStream(args):
-    input = int(args.input) if args.input.isnumeric() else args.input
-    stream = VideoStream(input)
+    detections = [Detections(classes, scores, boxes) for classes, scores, boxes in zip(*columns)]
+    if args.debug:
+        for imageDetections in detections:
+            debug("Detected {} objects in image: {}".format(len(imageDetections), imageDetections.names()))
+    return detections
+
+
+class Camera:
+    def __init__(self, source, session):
+        self.source = source
+        self.session = session
+        self.stream = connectStream(source, session)
+        self.redis = connectRedis(args, session)
+        self.frameId = getLastFrameId(self.redis)
+        self.motionGate = MotionGate(args.motion_threshold, args.motion_refresh)
+        self.lastDetection = None
+        self.tracker = Tracker(args.tracker)
+        self.tiler = createTiler(session)
+
+    def nextFrameId(self):
+        frameId = self.frameId
+        self.frameId = frameId + 1
+        return frameId
+
+    def reconnect(self):
+        self.stream = connectStream(self.source, self.session)
+
+    def release(self):
+        self.stream.release()
+
+
+def createTiler(session):
+    # without regions and tiles frames are analyzed whole, as they are
+    if args.regions:
+        return Tiler.load(args.regions, session, args.tile_size, args.tile_overlap)
+    if args.tile_size:
+        return Tiler(None, args.tile_size, args.tile_overlap)
+    return None
+
+
+def connectStream(source, name):
+    input = int(source) if source.isnumeric() else source
+    if args.decoder == 'ffmpeg':
+        # regions and tiles are cropped from frames of native resolution, scaling in the decoder would lose it
+        size = None if args.regions or args.tile_size else (args.input_size, args.input_size)
+        # decode twice per fastest sampling period, so a fresh frame is always waiting, without delay every frame
+        fps = 2.0 * max(args.max_fps, 1.0 / args.delay) if args.delay > 0 else 0
+        return FFmpegVideoStream(input, size, fps, args.keyframes_only, args.hwaccel, name)
+    stream = VideoStream(input, name)
     return stream
 
 
-def connectRedis(args):
-    redis = RedisClient(args.redis_server)
-    debug("Successfully connected to Redis.")
+def connectRedis(args, session):
+    # all cameras share one connection pool, keys are namespaced by session
+    redis = RedisClient(args.redis_server, session, socketTimeout=args.redis_timeout, retries=args.redis_retries)
+    redis.ping()
+    debug("Successfully connected to Redis. Session: '{}'.".format(session))
     return redis
 
 
 def getLastFrameId(redis):
-    lastid = redis.getLastFrameId()
-    return int(lastid) if lastid else 0
+    # frames may not be stored at all, ids continue after the last published one
+    return max(redis.getLastFrameId() or 0, redis.getLastDetectionId() or 0)
 
 
 def loadModel(args):
-    return tf.saved_model.load(args.saved_model)
-
+    allowed = allowedClasses([classIds[name] for name in args.classes] if args.classes else None)
+    model = createBackend(args.backend, args.saved_model, args.onnx_model, args.trt_cache, args.trt_precision,
+                          args.input_size, args.threshold, allowed)
+    warmUp(model, len(args.input), args.input_size)
+    print("Model startup: {}.".format(", ".join("{} {:.2f} s".format(phase, seconds)
+                                                 for phase, seconds in model.timings.items())), flush=True)
+    return model
+
+
+def storeInRedis(redis, frameBytes, detections, frameId):
+    if frameBytes is None:
+        redis.addDetections(frameId, detections)
+        debug("New detections added to Redis. Frame id: {:d}".format(frameId))
+        return
 
-def storeFrameInRedis(redis, frame, frameId):
-    frameBytes = cv2.imencode(".jpg", frame)[1].tostring()
-    redis.addFrame(frameId, frameBytes)
+    redis.addFrameWithDetections(frameId, frameBytes, detections)
     debug("New frame added to Redis. Frame id: {:d}".format(frameId))
 
 
-def extractDetections(saved_model, frame):
-    frame_expanded = np.array(frame)                
-    input_tensor = tf.convert_to_tensor(frame_expanded)
-    input_tensor = input_tensor[tf.newaxis, ...]
-    detections = saved_model(input_tensor)
-    return toDetectionDict(detections)
-
-
-def wait_routine(nightTime, stream):
-    if args.run_at_day:
-        return
-        
-    stream.release()
-    secondsToNightTime = nightTime.secondsTillNight()
-    delay = min(secondsToNightTime, hour)
+def toInputBatch(batch):
+    frames = []
+    for camera, _, _, frame in batch:
+        frames.extend(camera.tiler.crops(frame, args.input_size) if camera.tiler else [frame])
+    if any(frame.shape != frames[0].shape for frame in frames):
+        size = (args.input_size, args.input_size)
+        frames = [cv2.resize(frame, size, interpolation=cv2.INTER_AREA) for frame in frames]
+    return np.stack(frames)
+
+
+def mergeTiles(batch, detections):
+    # detections of all crops of a frame are merged into detections of the whole frame
+    merged = []
+    start = 0
+    for camera, _, _, frame in batch:
+        if camera.tiler is None:
+            merged.append(detections[start])
+            start += 1
+            continue
+        count = len(camera.tiler.getWindows(*frame.shape[:2]))
+        merged.append(camera.tiler.merge(detections[start:start + count], frame.shape))
+        start += count
+    return merged
+
+
+def extractDetections(model, batch):
+    start = time.perf_counter()
+    detections = model(batch)
+    inferenceSeconds.observe(time.perf_counter() - start, model.name)
+    if 'first inference' not in model.timings:
+        model.timings['first inference'] = time.perf_counter() - start
+        print("First inference took {:.3f} s.".format(model.timings['first inference']), flush=True)
+    return toDetections(detections, len(batch))
+
+
+def wait_routine(nightTime, cameras, sleep=time.sleep):
+    for camera in cameras:
+        camera.release()
+    delay = nightTime.secondsTillTransition()
     debug("It's a day! Taking nap for {} seconds.".format(delay))
-    time.sleep(delay)
-    stream = connectStream(args)
+    sleep(delay)
+    for camera in cameras:
+        camera.reconnect()
+
+
+def buildPipeline(nightTime, cameras, model, storage, sampling):
+    pipeline = Pipeline(args.queue_size)
+    state = {'nextCapture': 0.0, 'sinceDetection': args.detect_every}
+
+    def trackActivity(camera, timestamp):
+        now = time.time()
+        if camera.lastDetection is None or now - camera.lastDetection >= args.active_hold:
+            firstDetectionLatency.observe(now - timestamp, camera.session)
+            debug("First detection in '{}' published {:.3f} s after capture.".format(camera.session, now - timestamp))
+        camera.lastDetection = now
+        sampling.activity()
+
+    def capture():
+        if not args.run_at_day and not nightTime.isNight():
+            wait_routine(nightTime, cameras, pipeline.stopEvent.wait)
+            return None
+
+        pipeline.stopEvent.wait(max(state['nextCapture'] - time.time(), 0))
+        period = sampling.nextPeriod()
+        samplingRate.set(1.0 / period if period > 0 else 0.0)
+        state['nextCapture'] = deadline = time.time() + period
+
+        batch = []
+        for camera in cameras:
+            # wait for a frame not analyzed yet, stream may be stalled or reconnecting
+            frame = camera.stream.read_new(max(deadline - time.time(), 0))
+            if frame is None:
+                debug("Got no new image from '{}'".format(camera.session))
+                continue
+            if not camera.motionGate.hasChanged(frame.image):
+                framesSkipped.inc(camera.session)
+                continue
+            if camera.motionGate.moved:
+                sampling.activity()
+            framesProcessed.inc(camera.session)
+            # frame is a view into the stream ring buffer, keep own copy for next stages
+            batch.append((camera, camera.nextFrameId(), frame.timestamp, frame.image.copy()))
+        return batch or None
+
+    def shouldDetect(batch):
+        state['sinceDetection'] += 1
+        if state['sinceDetection'] < args.detect_every and not any(camera.tracker.lost for camera, _, _, _ in batch):
+            return False
+        state['sinceDetection'] = 0
+        return True
+
+    def preprocess(batch):
+        # batch without input is only tracked
+        if not shouldDetect(batch):
+            return batch, None
+        return batch, toInputBatch(batch)
+
+    def inference(item):
+        batch, inputBatch = item
+        if inputBatch is None:
+            for camera, _, _, _ in batch:
+                framesTracked.inc(camera.session)
+            return batch, [camera.tracker.predict(frame, timestamp) for camera, _, timestamp, frame in batch]
+
+        detections = mergeTiles(batch, extractDetections(model, inputBatch))
+        return batch, [camera.tracker.update(imageDetections, frame, timestamp)
+                       for (camera, _, timestamp, frame), imageDetections in zip(batch, detections)]
+
+    def publish(item):
+        # frames are encoded after inference, only the ones which will be stored
+        batch, detections = item
+        for (camera, frameId, timestamp, frame), imageDetections in zip(batch, detections):
+            if len(imageDetections):
+                trackActivity(camera, timestamp)
+            imageBytes = None
+            if storage.shouldStore(imageDetections):
+                imageBytes = storage.encode(frame)
+                framesStored.inc(camera.session)
+            storeInRedis(camera.redis, imageBytes, imageDetections, frameId)
+            for name in imageDetections.names():
+                detectionsPublished.inc(camera.session, name)
+
+    pipeline.addStage("capture", capture) \
+            .addStage("preprocess", preprocess) \
+            .addStage("inference", inference) \
+            .addStage("publish", publish)
+    return pipeline
 
 
 def main():
-    nightTime = NightTime()
-    stream = connectStream(args)
-    savedModel = loadModel(args)
-    redis = connectRedis(args)
-    frameId = getLastFrameId(redis)
-    
-    try:
-        while True:
-            if not args.run_at_day and not nightTime.isNight():
-                wait_routine(nightTime, stream)
-                continue
+    nightTime = NightTime(args.latitude, args.longitude)
+    cameras = [Camera(source, session) for source, session in zip(args.input, args.session)]
+    model = loadModel(args)
+    storage = FrameStorage(args.frame_format, args.frame_quality, args.frame_width, args.store_only_detected)
+    sampling = AdaptiveRate(args.delay, args.max_fps, args.active_hold, args.inference_budget)
+    pipeline = buildPipeline(nightTime, cameras, model, storage, sampling)
 
-            frame = stream.read()
-            if frame is None:
-                debug("Got empty image")
-                time.sleep(args.delay)
-                continue
-            
-            storeFrameInRedis(redis, frame, frameId)
-            detections = extractDetections(savedModel, frame)
-            redis.addDetections(frameId, detections)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
 
-            frameId = frameId + 1
-            time.sleep(args.delay)
+    try:
+        pipeline.start()
+        while pipeline.isRunning():
+            time.sleep(args.stats_interval)
+            for line in pipeline.report():
+                debug(line)
+            for camera in cameras:
+                debug("Motion gate '{}': skipped {:.1%} of frames.".format(camera.session, camera.motionGate.skipRatio()))
     except Exception as e:
         print(str(e))
     finally:
         debug("Exiting...")
-        stream.release()
+        pipeline.stop()
+        for camera in cameras:
+            camera.release()
 
 
 if __name__ == '__main__':
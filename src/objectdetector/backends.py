@@ -0,0 +1,203 @@
+import time
+from os import path
+
+import numpy as np
+
+from src.core.labels import category_map
+
+# Models produce outputs in the layout of TF object detection API: num_detections [batch],
+# detection_scores [batch, N], detection_boxes [batch, N, 4] and detection_classes [batch, N]
+# with 1-based COCO class ids.
+MODEL_OUTPUTS = ['num_detections', 'detection_scores', 'detection_boxes', 'detection_classes']
+# All backends take a batch of uint8 frames [batch, height, width, 3] and return numpy arrays of
+# detections above threshold of allowed classes only, flattened over batch and ordered by image:
+# image_index [K], detection_scores [K], detection_boxes [K, 4] and detection_classes [K].
+OUTPUTS = ['image_index', 'detection_scores', 'detection_boxes', 'detection_classes']
+
+
+def allowedClasses(classIds=None):
+    # allowed[classId] is True for classes which should be reported, all when classIds is None
+    allowed = np.zeros(max(category_map) + 1, dtype=bool)
+    allowed[list(category_map) if classIds is None else list(classIds)] = True
+    return allowed
+
+
+def inferInParts(model, batch, maxBatch):
+    # for models with fixed batch size, image indices of parts continue where the previous part ended
+    parts = [model(batch[i:i + maxBatch]) for i in range(0, len(batch), maxBatch)]
+    for offset, part in zip(range(0, len(batch), maxBatch), parts):
+        part['image_index'] = part['image_index'] + offset
+    return {key: np.concatenate([part[key] for part in parts]) for key in OUTPUTS}
+
+
+def filterDetections(detections, threshold, allowed):
+    numDetections = detections['num_detections'].astype(np.int64)
+    scores = detections['detection_scores']
+    classes = detections['detection_classes'].astype(np.int64)
+
+    # class ids unknown to the label map are not allowed
+    known = (classes >= 0) & (classes < len(allowed))
+    mask = (np.arange(scores.shape[1]) < numDetections[:, np.newaxis]) & (scores > threshold) \
+        & known & allowed[np.where(known, classes, 0)]
+    imageIndex, _ = np.nonzero(mask)
+    return {'image_index': imageIndex, 'detection_scores': scores[mask],
+            'detection_boxes': detections['detection_boxes'][mask], 'detection_classes': classes[mask]}
+
+
+class SavedModelBackend:
+    name = 'savedmodel'
+
+    def __init__(self, savedModel, threshold=0.5, allowed=None):
+        # tensorflow takes seconds to import, it is imported only when a backend needs it
+        start = time.perf_counter()
+        import tensorflow as tf
+
+        self.tf = tf
+        self.timings = {'import': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        self.model = self.load(savedModel)
+        self.signature = self.model.signatures['serving_default']
+        self.maxBatch = self.getMaxBatch()
+        self.detect = self.buildDetect(threshold, allowedClasses() if allowed is None else allowed)
+        self.timings['load'] = time.perf_counter() - start
+
+    def load(self, savedModel):
+        return self.tf.saved_model.load(savedModel)
+
+    def getMaxBatch(self):
+        # models exported by TF object detection API accept only [1, height, width, 3]
+        _, inputs = self.signature.structured_input_signature
+        return next(iter(inputs.values())).shape[0]
+
+    def infer(self, inputTensor):
+        return self.model(inputTensor)
+
+    def buildDetect(self, threshold, allowed):
+        # filtering runs in the graph, next to the model, only surviving detections are copied to host
+        tf = self.tf
+        allowedTable = tf.constant(allowed)
+
+        @tf.function(input_signature=[tf.TensorSpec([None, None, None, 3], tf.uint8)])
+        def detect(inputTensor):
+            detections = self.infer(inputTensor)
+            scores = detections['detection_scores']
+            classes = tf.cast(detections['detection_classes'], tf.int32)
+            numDetections = tf.cast(detections['num_detections'], tf.int32)
+
+            valid = tf.range(tf.shape(scores)[1])[tf.newaxis, :] < numDetections[:, tf.newaxis]
+            # class ids unknown to the label map are not allowed
+            known = (classes >= 0) & (classes < len(allowed))
+            allowedClass = known & tf.gather(allowedTable, tf.where(known, classes, tf.zeros_like(classes)))
+            indices = tf.where(valid & (scores > threshold) & allowedClass)
+            return {'image_index': indices[:, 0],
+                    'detection_scores': tf.gather_nd(scores, indices),
+                    'detection_boxes': tf.gather_nd(detections['detection_boxes'], indices),
+                    'detection_classes': tf.gather_nd(classes, indices)}
+
+        return detect
+
+    def __call__(self, batch):
+        if self.maxBatch and len(batch) > self.maxBatch:
+            return inferInParts(self, batch, self.maxBatch)
+
+        detections = self.detect(self.tf.convert_to_tensor(batch))
+        return {key: detections[key].numpy() for key in OUTPUTS}
+
+
+class TensorRTBackend(SavedModelBackend):
+    name = 'tensorrt'
+
+    def __init__(self, savedModel, cacheDir, precision='FP16', inputSize=320, threshold=0.5, allowed=None):
+        self.cacheDir = cacheDir
+        self.precision = precision
+        self.inputShape = (1, inputSize, inputSize, 3)
+        super().__init__(savedModel, threshold, allowed)
+
+    def load(self, savedModel):
+        # conversion and engine build take minutes on Jetson, converted model is stored for next runs
+        modelName = path.basename(path.normpath(savedModel))
+        convertedModel = path.join(self.cacheDir, '{}_trt_{}_{}'.format(modelName, self.precision.lower(),
+                                                                       'x'.join(map(str, self.inputShape))))
+        if not path.exists(convertedModel):
+            self.convert(savedModel, convertedModel)
+
+        return self.tf.saved_model.load(convertedModel)
+
+    def convert(self, savedModel, convertedModel):
+        from tensorflow.python.compiler.tensorrt import trt_convert as trt
+
+        print("Converting '{}' to TensorRT {} model '{}'.".format(savedModel, self.precision, convertedModel), flush=True)
+        params = trt.DEFAULT_TRT_CONVERSION_PARAMS._replace(precision_mode=self.precision,
+                                                            max_workspace_size_bytes=1 << 28)
+        converter = trt.TrtGraphConverterV2(input_saved_model_dir=savedModel, conversion_params=params)
+        converter.convert()
+
+        def inputFn():
+            # every item is a sequence of model inputs
+            yield (self.tf.zeros(self.inputShape, dtype=self.tf.uint8),)
+
+        converter.build(input_fn=inputFn)
+        converter.save(convertedModel)
+
+    def infer(self, inputTensor):
+        return self.signature(input_tensor=inputTensor)
+
+
+class OnnxBackend:
+    # CPU backend for development machines, model converted by
+    # python -m tf2onnx.convert --saved-model saved_model --output model.onnx
+    name = 'onnx'
+
+    def __init__(self, onnxModel, threshold=0.5, allowed=None):
+        self.threshold = threshold
+        self.allowed = allowedClasses() if allowed is None else allowed
+
+        start = time.perf_counter()
+        import onnxruntime
+
+        self.timings = {'import': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        self.session = onnxruntime.InferenceSession(onnxModel, providers=['CPUExecutionProvider'])
+        modelInput = self.session.get_inputs()[0]
+        self.inputName = modelInput.name
+        # tf2onnx keeps the fixed batch of 1 of TF object detection API models, dynamic dimension is a name
+        self.maxBatch = modelInput.shape[0] if isinstance(modelInput.shape[0], int) else None
+        self.timings['load'] = time.perf_counter() - start
+
+    def __call__(self, batch):
+        if self.maxBatch and len(batch) > self.maxBatch:
+            return inferInParts(self, batch, self.maxBatch)
+
+        outputs = self.session.run(MODEL_OUTPUTS, {self.inputName: batch})
+        return filterDetections(dict(zip(MODEL_OUTPUTS, outputs)), self.threshold, self.allowed)
+
+
+backends = [SavedModelBackend.name, TensorRTBackend.name, OnnxBackend.name]
+
+
+def createBackend(name, savedModel, onnxModel=None, cacheDir='/data/trt_cache', precision='FP16', inputSize=320,
+                  threshold=0.5, allowed=None):
+    if name == SavedModelBackend.name:
+        return SavedModelBackend(savedModel, threshold, allowed)
+    if name == TensorRTBackend.name:
+        try:
+            return TensorRTBackend(savedModel, cacheDir, precision, inputSize, threshold, allowed)
+        except Exception as ex:
+            # detection keeps running, only slower
+            print("TensorRT backend is not available ({}), falling back to '{}'.".format(str(ex), SavedModelBackend.name),
+                  flush=True)
+            return SavedModelBackend(savedModel, threshold, allowed)
+    if name == OnnxBackend.name:
+        if onnxModel is None:
+            raise ValueError("Backend '{}' requires path to ONNX model.".format(name))
+        return OnnxBackend(onnxModel, threshold, allowed)
+    raise ValueError("Unknown inference backend '{}'.".format(name))
+
+
+def warmUp(model, batchSize, inputSize):
+    # first call allocates memory and optimizes the graph, it would otherwise delay the first real detection
+    start = time.perf_counter()
+    model(np.zeros((batchSize, inputSize, inputSize, 3), dtype=np.uint8))
+    model.timings['warm-up'] = time.perf_counter() - start
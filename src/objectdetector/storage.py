@@ -0,0 +1,33 @@
+import cv2
+
+# Frames are stored in redis only for the visualizer, they are not needed for light control.
+formats = {'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY), 'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY), 'none': None}
+
+
+class FrameStorage:
+    def __init__(self, format='jpeg', quality=95, width=0, onlyWithDetections=False):
+        # width: frames wider than width are downscaled before encoding, 0 keeps full resolution
+        if format not in formats:
+            raise ValueError("Unknown frame format '{}'.".format(format))
+        self.format = format
+        self.quality = quality
+        self.width = width
+        self.onlyWithDetections = onlyWithDetections
+
+    def shouldStore(self, detections):
+        if self.format == 'none':
+            return False
+        return not self.onlyWithDetections or len(detections) > 0
+
+    def encode(self, frame):
+        height, width = frame.shape[:2]
+        if self.width and width > self.width:
+            # boxes are normalized, they stay valid for the thumbnail
+            size = (self.width, max(round(height * self.width / width), 1))
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+        extension, qualityFlag = formats[self.format]
+        ok, encoded = cv2.imencode(extension, frame, [qualityFlag, self.quality])
+        if not ok:
+            raise ValueError("Frame can not be encoded as '{}'.".format(self.format))
+        return encoded.tobytes()
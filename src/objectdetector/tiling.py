@@ -0,0 +1,113 @@
+import json
+import math
+
+import cv2
+import numpy as np
+
+from src.core.detections import Detections
+
+wholeFrame = [[0.0, 0.0], [1.0, 1.0]]
+
+
+class Tiler:
+    # Instead of the whole frame, the model analyzes crops of regions of interest. Regions bigger than tileSize
+    # pixels are split into overlapping tiles, so distant objects are not shrunk to a few pixels.
+    # Boxes found in crops are mapped back to whole frame coordinates, duplicates from overlaps are removed by NMS.
+    #
+    # Regions file maps session to regions given by top left and bottom right corner in normalized coordinates,
+    # 'default' is used for sessions not listed:
+    # {
+    #     "default": [[[0.0, 0.3], [1.0, 1.0]]],
+    #     "driveway": [[[0.0, 0.4], [0.6, 1.0]], [[0.6, 0.3], [1.0, 0.8]]]
+    # }
+    iouThreshold = 0.5
+    # part of an object cut by tile edge lies inside the box found in the neighbouring tile
+    containThreshold = 0.8
+
+    def __init__(self, regions=None, tileSize=0, overlap=0.2):
+        # tileSize: maximal tile size in pixels, 0 analyzes each region as a single crop
+        self.regions = np.array([[y1, x1, y2, x2] for (x1, y1), (x2, y2) in (regions or [wholeFrame])],
+                                dtype=np.float32)
+        if np.any(self.regions[:, :2] >= self.regions[:, 2:]) or np.any(self.regions < 0) or np.any(self.regions > 1):
+            raise ValueError("Regions must be given by top left and bottom right corner inside the frame.")
+        self.tileSize = tileSize
+        self.overlap = overlap
+        self.windows = {}  # frame shape -> windows [N, 4] as [ymin, xmin, ymax, xmax]
+
+    @classmethod
+    def load(cls, path, session, tileSize=0, overlap=0.2):
+        with open(path) as file:
+            regions = json.load(file)
+        return cls(regions.get(session, regions.get('default')), tileSize, overlap)
+
+    def getWindows(self, height, width):
+        windows = self.windows.get((height, width))
+        if windows is None:
+            windows = self.windows[(height, width)] = np.concatenate(
+                [self.tile(region, height, width) for region in self.regions])
+        return windows
+
+    def tile(self, region, height, width):
+        ymin, xmin, ymax, xmax = region
+        if not self.tileSize:
+            return region[np.newaxis]
+
+        rows = max(math.ceil((ymax - ymin) * height / self.tileSize), 1)
+        cols = max(math.ceil((xmax - xmin) * width / self.tileSize), 1)
+        # tiles of n parts with overlap cover the region exactly
+        tileHeight = (ymax - ymin) / (rows - (rows - 1) * self.overlap)
+        tileWidth = (xmax - xmin) / (cols - (cols - 1) * self.overlap)
+        tops = ymin + np.arange(rows) * tileHeight * (1 - self.overlap)
+        lefts = xmin + np.arange(cols) * tileWidth * (1 - self.overlap)
+        tops, lefts = [grid.ravel() for grid in np.meshgrid(tops, lefts, indexing='ij')]
+        return np.stack([tops, lefts, tops + tileHeight, lefts + tileWidth], axis=1).astype(np.float32)
+
+    def crops(self, frame, inputSize):
+        height, width = frame.shape[:2]
+        pixels = np.round(self.getWindows(height, width) * np.array([height, width, height, width])).astype(int)
+        size = (inputSize, inputSize)
+        return [cv2.resize(frame[top:max(bottom, top + 1), left:max(right, left + 1)], size, interpolation=cv2.INTER_AREA)
+                for top, left, bottom, right in pixels]
+
+    def merge(self, detections, frameShape):
+        # detections: one per window, boxes are normalized to their window
+        windows = self.getWindows(*frameShape[:2])
+        counts = [len(windowDetections) for windowDetections in detections]
+        if sum(counts) == 0:
+            return Detections.empty()
+
+        window = np.repeat(windows, counts, axis=0)
+        boxes = np.concatenate([windowDetections.boxes for windowDetections in detections])
+        origin = window[:, [0, 1, 0, 1]]
+        scale = (window[:, [2, 3, 2, 3]] - origin)
+        boxes = origin + boxes * scale
+        classes = np.concatenate([windowDetections.classes for windowDetections in detections])
+        scores = np.concatenate([windowDetections.scores for windowDetections in detections])
+
+        if len(windows) > 1:
+            keep = self.suppress(classes, scores, boxes)
+            classes, scores, boxes = classes[keep], scores[keep], boxes[keep]
+        return Detections(classes, scores, boxes)
+
+    def suppress(self, classes, scores, boxes):
+        # greedy non-maximum suppression across windows, boxes of different classes do not suppress each other
+        order = np.argsort(-scores, kind='stable')
+        classes, boxes = classes[order], boxes[order]
+
+        top = np.maximum(boxes[:, np.newaxis, 0], boxes[np.newaxis, :, 0])
+        left = np.maximum(boxes[:, np.newaxis, 1], boxes[np.newaxis, :, 1])
+        bottom = np.minimum(boxes[:, np.newaxis, 2], boxes[np.newaxis, :, 2])
+        right = np.minimum(boxes[:, np.newaxis, 3], boxes[np.newaxis, :, 3])
+        intersection = np.clip(bottom - top, 0, None) * np.clip(right - left, 0, None)
+        area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        union = area[:, np.newaxis] + area[np.newaxis, :] - intersection
+        smaller = np.minimum(area[:, np.newaxis], area[np.newaxis, :])
+        duplicate = ((intersection > self.iouThreshold * np.maximum(union, 1e-9))
+                     | (intersection > self.containThreshold * np.maximum(smaller, 1e-9))) \
+            & (classes[:, np.newaxis] == classes[np.newaxis, :])
+
+        suppressed = np.zeros(len(order), dtype=bool)
+        for i in range(len(order)):
+            if not suppressed[i]:
+                suppressed |= duplicate[i] & (np.arange(len(order)) > i)
+        return order[~suppressed]
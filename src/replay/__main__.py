@@ -0,0 +1,233 @@
+import json
+import os
+import time
+import multiprocessing as mp
+from queue import Empty
+
+import argparse
+import numpy as np
+
+from src.core.detections import Detections
+from src.core.rules import Rules, classIds
+from src.objectdetector.backends import backends, allowedClasses, createBackend, warmUp
+from src.replay.decoder import DONE, frameSlots, splitVideos, decode
+
+# objects of interest, the same as default rule of lightcontrol
+OOI = ['person', 'car', 'bicycle']
+
+parser = argparse.ArgumentParser(description="Detect objects in recorded videos and count how often lights would be"
+                                 " triggered. Frames are decoded by worker processes and analyzed in batches.")
+parser.add_argument('-i', '--input', metavar='video.mp4', type=str, nargs='+', default=[],
+                    help="Recorded videos to analyze.")
+parser.add_argument('-o', '--output', metavar='detections.npz', type=str, default='detections.npz',
+                    help="File to write detections of every analyzed frame to. Default 'detections.npz'.")
+parser.add_argument('--load', metavar='detections.npz', type=str, default=None,
+                    help="Evaluate rules against detections written by a previous run instead of analyzing --input.")
+parser.add_argument('--delay', metavar='N.N', type=float, default=1.0,
+                    help="Analyze one frame per N seconds of video, as objectdetector does. Default 1.0 .")
+parser.add_argument('-w', '--workers', metavar='N', type=int, default=max((os.cpu_count() or 2) - 1, 1),
+                    help="Decoder processes. Default number of CPUs - 1.")
+parser.add_argument('--batch', metavar='N', type=int, default=8, help="Frames per inference call. Default 8.")
+parser.add_argument('-m', '--saved-model', type=str, default="/data/saved_model", help="Pre-trained model to load.")
+parser.add_argument('-b', '--backend', choices=backends, default='savedmodel', help="Inference backend. Default 'savedmodel'.")
+parser.add_argument('--onnx-model', metavar='model.onnx', type=str, default=None, help="ONNX model for 'onnx' backend.")
+parser.add_argument('--trt-cache', metavar='directory', type=str, default="/data/trt_cache",
+                    help="Directory for TensorRT converted models. Default '/data/trt_cache'.")
+parser.add_argument('--trt-precision', choices=['FP32', 'FP16', 'INT8'], default='FP16', help="TensorRT precision. Default 'FP16'.")
+parser.add_argument('--input-size', metavar='N', type=int, default=320, help="Frames are scaled to NxN. Default 320.")
+parser.add_argument('-t', '--threshold', type=float, default=0.5, help="Minimum detection threshold to use.")
+parser.add_argument('--classes', metavar='name', type=str, nargs='+', default=None,
+                    help="Report only these classes, e.g. 'person car'. Default all classes.")
+parser.add_argument('--rules', metavar='rules.json', type=str, default=None,
+                    help="Rules of lightcontrol to evaluate. Default is switching a light for --period seconds"
+                    " when person, car or bicycle is detected.")
+parser.add_argument('-p', '--period', type=float, default=5, help="Light period of the default rule. Default 5.")
+parser.add_argument('--summary', metavar='summary.json', type=str, default=None, help="Write trigger summary as JSON.")
+
+args = parser.parse_args()
+
+if not args.input and not args.load:
+    parser.error("Give videos to analyze with --input or detections to evaluate with --load.")
+unknownClasses = set(args.classes or []) - set(classIds)
+if unknownClasses:
+    parser.error("Unknown classes: {}.".format(", ".join(sorted(unknownClasses))))
+
+
+class ReplayDetections:
+    # Detections of all analyzed frames in columns. Detections of frame i are rows offsets[i]:offsets[i + 1].
+    def __init__(self, videos, videoIndex, frameNumbers, times, offsets, classes, scores, boxes):
+        self.videos = list(videos)
+        self.videoIndex = videoIndex
+        self.frameNumbers = frameNumbers
+        self.times = times
+        self.offsets = offsets
+        self.classes = classes
+        self.scores = scores
+        self.boxes = boxes
+
+    def __len__(self):
+        return len(self.frameNumbers)
+
+    def __getitem__(self, i):
+        rows = slice(self.offsets[i], self.offsets[i + 1])
+        return Detections(self.classes[rows], self.scores[rows], self.boxes[rows])
+
+    @classmethod
+    def fromFrames(cls, videos, frames):
+        # frames: (videoIndex, frameNumber, time, Detections), ordered by video and frame number
+        counts = [len(detections) for _, _, _, detections in frames]
+        columns = [np.concatenate([getattr(detections, name) for _, _, _, detections in frames])
+                   if frames else np.empty(0) for name in ['classes', 'scores', 'boxes']]
+        return cls(videos,
+                   np.array([frame[0] for frame in frames], dtype=np.uint16),
+                   np.array([frame[1] for frame in frames], dtype=np.uint32),
+                   np.array([frame[2] for frame in frames], dtype=np.float64),
+                   np.concatenate([[0], np.cumsum(counts)]).astype(np.uint32),
+                   columns[0].astype(Detections.classType), columns[1].astype(Detections.scoreType),
+                   columns[2].astype(Detections.boxType).reshape(-1, 4))
+
+    def save(self, path):
+        np.savez_compressed(path, videos=np.array(self.videos), video_index=self.videoIndex,
+                            frame_numbers=self.frameNumbers, times=self.times, offsets=self.offsets,
+                            classes=self.classes, scores=self.scores, boxes=self.boxes)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['videos'].tolist(), data['video_index'], data['frame_numbers'], data['times'],
+                       data['offsets'], data['classes'], data['scores'], data['boxes'])
+
+
+def loadModel(args):
+    allowed = allowedClasses([classIds[name] for name in args.classes] if args.classes else None)
+    model = createBackend(args.backend, args.saved_model, args.onnx_model, args.trt_cache, args.trt_precision,
+                          args.input_size, args.threshold, allowed)
+    warmUp(model, args.batch, args.input_size)
+    return model
+
+
+def startDecoders(args):
+    # frames are decoded in worker processes while the main process runs inference
+    tasks = splitVideos(args.input, args.delay, args.workers)
+    slotCount = args.batch * (args.workers + 2)
+    frameSize = args.input_size * args.input_size * 3
+    sharedBuffer = mp.RawArray('B', slotCount * frameSize)
+    slots = frameSlots(sharedBuffer, args.input_size)
+
+    taskQueue, freeSlots, decodedFrames = mp.Queue(), mp.Queue(), mp.Queue()
+    for task in tasks:
+        taskQueue.put(task)
+    for slot in range(slotCount):
+        freeSlots.put(slot)
+    workers = [mp.Process(target=decode, args=(taskQueue, freeSlots, decodedFrames, sharedBuffer, args.input_size),
+                          daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        taskQueue.put(DONE)
+        worker.start()
+    return workers, slots, freeSlots, decodedFrames
+
+
+def analyze(args, model, workers, slots, freeSlots, decodedFrames):
+    frames = []
+    running = len(workers)
+    try:
+        while running:
+            batch = []
+            # wait for the first frame, then take what is already decoded
+            try:
+                item = decodedFrames.get(timeout=1)
+            except Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("Decoder processes exited unexpectedly.")
+                continue
+            while True:
+                if item is DONE:
+                    running -= 1
+                else:
+                    batch.append(item)
+                if len(batch) == args.batch or not running:
+                    break
+                try:
+                    item = decodedFrames.get_nowait()
+                except Empty:
+                    break
+            if not batch:
+                continue
+
+            slotIndices = [slot for _, _, _, slot in batch]
+            inputBatch = slots[slotIndices]  # fancy indexing copies, slots can be reused right away
+            for slot in slotIndices:
+                freeSlots.put(slot)
+
+            outputs = model(inputBatch)
+            bounds = np.searchsorted(outputs['image_index'], np.arange(1, len(batch)))
+            columns = [np.split(outputs[key], bounds)
+                       for key in ['detection_classes', 'detection_scores', 'detection_boxes']]
+            for (videoIndex, frameNumber, frameTime, _), classes, scores, boxes in zip(batch, *columns):
+                frames.append((videoIndex, frameNumber, frameTime, Detections(classes, scores, boxes)))
+    finally:
+        for worker in workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+
+    frames.sort(key=lambda frame: (frame[0], frame[1]))
+    return ReplayDetections.fromFrames(args.input, frames)
+
+
+def summarize(rules, replay):
+    # light of a rule stays on for its period after the last match, a match of a switched off light is a trigger
+    summary = {name: {'triggers': 0, 'on_seconds': 0.0, 'matched_frames': 0} for name in rules.names}
+    periods = np.array(rules.periods)
+    offAt = np.full(len(rules), -np.inf)
+    lastVideo = None
+    for i in range(len(replay)):
+        if replay.videoIndex[i] != lastVideo:
+            # every video starts with lights off
+            lastVideo = replay.videoIndex[i]
+            offAt[:] = -np.inf
+
+        frameTime = replay.times[i]
+        matched = rules.evaluate(replay[i])
+        for rule in matched.nonzero()[0]:
+            result = summary[rules.names[rule]]
+            result['matched_frames'] += 1
+            if frameTime >= offAt[rule]:
+                result['triggers'] += 1
+                result['on_seconds'] += periods[rule]
+            else:
+                result['on_seconds'] += frameTime + periods[rule] - offAt[rule]
+            offAt[rule] = frameTime + periods[rule]
+    return summary
+
+
+def main():
+    rules = Rules.load(args.rules) if args.rules else \
+        Rules([{'name': 'default', 'classes': OOI, 'pin': -1, 'period': args.period}])
+
+    if args.load:
+        replay = ReplayDetections.load(args.load)
+    else:
+        # decoders are forked before tensorflow starts its threads, a fork of a process with them can deadlock
+        decoders = startDecoders(args)
+        model = loadModel(args)
+        start = time.perf_counter()
+        replay = analyze(args, model, *decoders)
+        elapsed = time.perf_counter() - start
+        replay.save(args.output)
+        duration = float(replay.times.max()) if len(replay) else 0.0
+        print("Analyzed {} frames of {} videos in {:.1f} s ({:.1f} frames/s), {} detections written to '{}'.".format(
+            len(replay), len(args.input), elapsed, len(replay) / max(elapsed, 1e-9), len(replay.scores), args.output))
+        print("Longest video: {:.0f} s, replayed {:.1f}x faster than real time.".format(duration, duration / max(elapsed, 1e-9)))
+
+    summary = summarize(rules, replay)
+    print("{:>20} {:>10} {:>12} {:>15}".format("rule", "triggers", "on seconds", "matched frames"))
+    for name, result in summary.items():
+        print("{:>20} {:>10} {:>12.0f} {:>15}".format(name, result['triggers'], result['on_seconds'], result['matched_frames']))
+    if args.summary:
+        with open(args.summary, 'w') as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+
+# Decoder processes write frames into slots of one shared buffer, only slot numbers travel through queues.
+DONE = None
+
+
+def frameSlots(sharedBuffer, inputSize):
+    return np.frombuffer(sharedBuffer, dtype=np.uint8).reshape(-1, inputSize, inputSize, 3)
+
+
+def videoInfo(video):
+    capture = cv2.VideoCapture(video)
+    try:
+        if not capture.isOpened():
+            raise ValueError("Can not open video '{}'.".format(video))
+        return int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), capture.get(cv2.CAP_PROP_FPS) or 25.0
+    finally:
+        capture.release()
+
+
+def splitVideos(videos, delay, workers):
+    # each video is cut into segments, so a single long recording is also decoded by all workers
+    tasks = []
+    for videoIndex, video in enumerate(videos):
+        frameCount, fps = videoInfo(video)
+        step = max(int(round(fps * delay)), 1)
+        segment = max(frameCount // workers, step)
+        # segments start on sampled frames
+        segment = (segment + step - 1) // step * step
+        tasks.extend((videoIndex, video, fps, step, start, min(start + segment, frameCount))
+                     for start in range(0, frameCount, segment))
+    return tasks
+
+
+def decode(tasks, freeSlots, decodedFrames, sharedBuffer, inputSize):
+    # worker process: decodes every step-th frame of its segments, scaled to inputSize x inputSize
+    slots = frameSlots(sharedBuffer, inputSize)
+    size = (inputSize, inputSize)
+    while True:
+        task = tasks.get()
+        if task is DONE:
+            decodedFrames.put(DONE)
+            return
+
+        videoIndex, video, fps, step, start, end = task
+        capture = cv2.VideoCapture(video)
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        try:
+            for frameNumber in range(start, end):
+                # grab() still decodes skipped frames, it only saves their color conversion, copy and resize
+                if (frameNumber - start) % step:
+                    if not capture.grab():
+                        break
+                    continue
+
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                slot = freeSlots.get()
+                slots[slot] = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                decodedFrames.put((videoIndex, frameNumber, frameNumber / fps, slot))
+        finally:
+            capture.release()
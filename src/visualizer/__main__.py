@@ -3,16 +3,30 @@ from datetime import datetime
 import cv2
 import argparse
 import numpy as np
+from redis.exceptions import RedisError
 
 from src.core.redisclient import RedisClient
+from src.visualizer.mjpeg import MjpegServer
+from src.core import metrics
 
 parser = argparse.ArgumentParser(description="Visualize data from redis.")
 parser.add_argument('-r', '--redis-server', metavar='server:port', type=str, default='redis:6379',
-                    help="URL to redis server. Default 'redis:6379'.")
+                    help="URL to redis server, or path to its unix socket as 'unix:///path/redis.sock'. Default 'redis:6379'.")
+parser.add_argument('--redis-timeout', metavar='N.N', type=float, default=5.0,
+                    help="Redis socket timeout in seconds. Default 5.")
+parser.add_argument('--redis-retries', metavar='N', type=int, default=3,
+                    help="How many times to retry redis operation after connection error. Default 3.")
 parser.add_argument('-s', '--session', metavar='session-name', type=str, default='default',
                     help="Session identification. Frames will be stored in redis under 'session-name:key'."
                     "The same will be used for ZeroMQ. Default 'default'.")
 parser.add_argument('-d', '--debug', action='store_true', help="Write debug messages to console.")
+parser.add_argument('--metrics-port', metavar='N', type=int, default=0,
+                    help="Serve Prometheus metrics on http://host:N/metrics. Default 0 (disabled).")
+parser.add_argument('--port', metavar='N', type=int, default=0,
+                    help="Serve frames as MJPEG stream on http://host:N/ instead of showing them in a window."
+                    " Any number of browsers can watch, every frame is read and encoded once. Default 0 (window).")
+parser.add_argument('--jpeg-quality', metavar='N', type=int, default=80,
+                    help="Quality (0-100) of frames sent to browsers. Default 80.")
 parser.add_argument('--raw', action='store_true', help="Show clean frames without detections."
                     "Otherwise frames with detected objects will be displayed.")
 
@@ -20,6 +34,9 @@ args = parser.parse_args()
 print("Arguments:")
 print(args)
 
+frameTimeout = 5  # seconds
+redisErrorDelay = 5  # seconds
+framesShown = metrics.counter('visualizer_frames_shown_total', "Frames displayed by visualizer.")
 font = cv2.FONT_HERSHEY_SIMPLEX
 red = (125, 0, 0)
 
@@ -30,7 +47,7 @@ def debug(text):
 
 
 def next_frame(redis):
-    frameId = redis.getLastFrameId()
+    frameId = redis.waitForFrameId(frameTimeout)
     if frameId is None:
         return None        
     
@@ -49,11 +66,9 @@ def visualize(frame, detections):
     height = frame.shape[0]
     width = frame.shape[1]
 
-    for detection in detections:
-        data = detections[detection]
-        text = "{} {:.0f}%".format(data['class'], data['score']*100)
-        box = data['box'] * np.array([height, width, height, width])
-        box = box.astype(int)
+    boxes = (detections.boxes * np.array([height, width, height, width])).astype(int)
+    for name, score, box, trackId in zip(detections.names(), detections.scores, boxes, detections.trackIds):
+        text = "{} {:.0f}%".format(name, score*100) if trackId == 0 else "{} #{} {:.0f}%".format(name, trackId, score*100)
         frame = cv2.rectangle(frame, (box[1], box[0]), (box[3], box[2]), red, 3)
         frame = cv2.putText(frame, text, (box[1], box[0]-5), font, 0.8, red, 2, cv2.LINE_AA) 
    
@@ -61,7 +76,7 @@ def visualize(frame, detections):
 
 
 def next_detection(redis):
-    detectionId = redis.getLastDetectionId()
+    detectionId = redis.waitForDetectionId(frameTimeout)
 
     if detectionId is None:
         return None
@@ -75,20 +90,52 @@ def next_detection(redis):
     return visualize(frame, detections)
 
 
+def next_image(redis):
+    try:
+        frame = next_frame(redis) if args.raw else next_detection(redis)
+    except RedisError as e:
+        print("Redis is not available: {}".format(str(e)), flush=True)
+        time.sleep(redisErrorDelay)
+        return None
+
+    if frame is None:
+        debug("New image is not available.")
+    return frame
+
+
+def next_encoded_image(redis):
+    frame = next_image(redis)
+    if frame is None:
+        return None
+
+    framesShown.inc()
+    return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality])[1].tobytes()
+
+
 def main():
-    redis = RedisClient(args.redis_server)
-    debug("Successfully connected to Redis.")
+    redis = RedisClient(args.redis_server, args.session, socketTimeout=args.redis_timeout, retries=args.redis_retries)
+    redis.ping()
+    debug("Successfully connected to Redis. Session: '{}'.".format(args.session))
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    if args.port:
+        try:
+            MjpegServer(lambda: next_encoded_image(redis), args.port).run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            debug("Exiting...")
+        return
 
     try:
         while True:
-            frame = next_frame(redis) if args.raw else next_detection(redis)
-
+            frame = next_image(redis)
             if frame is None:
-                debug("New image is not available.")
-                time.sleep(5)
                 continue
             
             cv2.imshow('object detection', frame)
+            framesShown.inc()
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 cv2.destroyAllWindows()
                 break
@@ -0,0 +1,120 @@
+import asyncio
+from contextlib import contextmanager
+
+from src.core import metrics
+
+clientsConnected = metrics.gauge('visualizer_clients', "Browsers watching the MJPEG stream.")
+framesSent = metrics.counter('visualizer_frames_sent_total', "Frames written to MJPEG clients.")
+
+boundary = b'frame'
+page = b"""<!DOCTYPE html>
+<html><head><title>object detection</title></head>
+<body style="margin:0;background:#000"><img src="/stream" style="width:100%"></body></html>
+"""
+
+
+class MjpegServer:
+    # Frames are read, drawn and encoded once by a single producer, the same bytes are written to all clients.
+    # Frames are produced only while somebody watches. Slow clients skip frames, they always get the newest one.
+    # Written for asyncio of python 3.6, which runs on Jetson.
+
+    def __init__(self, nextImage, port, host=''):
+        # nextImage: blocking function returning the next JPEG encoded frame or None, it runs in a worker thread
+        self.nextImage = nextImage
+        self.port = port
+        self.host = host
+        self.image = None
+        self.sequence = 0
+        self.clients = 0
+        self.loop = None
+        self.newImage = None
+        self.watched = None
+
+    def run(self):
+        self.loop = asyncio.get_event_loop()
+        self.newImage = asyncio.Condition()
+        self.watched = asyncio.Event()
+        server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host or None, self.port))
+        print("Visualizer is served on http://{}:{}/".format(self.host or 'localhost', self.port), flush=True)
+        try:
+            self.loop.run_until_complete(self.produce())
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+
+    async def produce(self):
+        while True:
+            await self.watched.wait()
+            image = await self.loop.run_in_executor(None, self.nextImage)
+            if image is None:
+                continue
+            async with self.newImage:
+                self.image = image
+                self.sequence += 1
+                self.newImage.notify_all()
+
+    async def handle(self, reader, writer):
+        try:
+            requestLine = await reader.readline()
+            # headers are not needed
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = requestLine.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else '/'
+            if path == '/':
+                self.writeResponse(writer, b'text/html; charset=utf-8', page)
+            elif path == '/stream':
+                await self.stream(writer)
+            elif path == '/snapshot.jpg':
+                with self.watching():
+                    image, _ = await self.nextFrame(0)
+                self.writeResponse(writer, b'image/jpeg', image)
+            else:
+                self.writeResponse(writer, b'text/plain', b'Not found\n', b'404 Not Found')
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def writeResponse(self, writer, contentType, body, status=b'200 OK'):
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: ' + contentType
+                     + b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n')
+        writer.write(body)
+
+    async def stream(self, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=' + boundary
+                     + b'\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+        sequence = 0
+        with self.watching():
+            while True:
+                image, sequence = await self.nextFrame(sequence)
+                writer.write(b'--' + boundary + b'\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                             + str(len(image)).encode() + b'\r\n\r\n')
+                writer.write(image)
+                writer.write(b'\r\n')
+                await writer.drain()
+                framesSent.inc()
+
+    async def nextFrame(self, sequence):
+        # waits for a frame newer than sequence
+        async with self.newImage:
+            await self.newImage.wait_for(lambda: self.image is not None and self.sequence != sequence)
+            return self.image, self.sequence
+
+    @contextmanager
+    def watching(self):
+        self.setClients(self.clients + 1)
+        try:
+            yield
+        finally:
+            self.setClients(self.clients - 1)
+
+    def setClients(self, clients):
+        self.clients = clients
+        clientsConnected.set(clients)
+        if clients:
+            self.watched.set()
+        else:
+            self.watched.clear()